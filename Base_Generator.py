@@ -1,19 +1,34 @@
 import numpy as np
 import os
+import sys
 import shutil
 import multiprocessing
 import tifffile
 import datetime
 import time
+import asyncio
 from PIL import Image
 from joblib import Parallel, delayed
 from hashlib import md5
 from pathlib import Path
-from subprocess import call
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import image_conversion_fun as imProc
-from random_dev import devRandomGenerator
+import tiling
+from random_dev import devRandomGenerator, KERNEL_dict
 from fix_dev import devFixGenerator
+from decoder_routing import decoderRouter, routing_key
+from external_tools import toolRunner
+from progress_metrics import record_event, metricsAggregator
+from memory_budget import memoryBudget
+from stage_cache import stageCache, stage_hash, file_identity, file_content_hash
+from raw_dedup import rawDeduplicator, embedded_preview
+from packed_export import packedExport
+from manifest import outputManifest, verify_manifest
+from param_store import paramStore, DEV_PARAM_SCHEMA
+from output_versions import versionedOutputs, current_target
+from raw_prefetch import rawPrefetcher, claim_staged_raw, release_staged_raw
 
 # Note that this first variable is used to allows several development, with possibly various settings, with names
 # that can be easily identified Switch indicating whether an uncompressed version (tiff) of the developed images
@@ -29,10 +44,42 @@ bool_random_dev = True
 bool_multicrop = True
 # If we want all images in gray, active the following boolean
 bool_grayscale = True
+# Each development parameter of an image is drawn from (seed of the image, name of the parameter) instead of the next
+# value of a single random stream, hence it does not change when the probabilities of other parameters (or the stages
+# that are enabled) change (see "keyed_rng.py"). Note that switching it changes the development of all images.
+bool_keyed_rng = False
+
+# Preview mode, to check in a few minutes the effect of the distributions of config_process (USM amount, denoising,
+# resizing factor ...): only "preview_nb_images" RAW images of each RAW base are converted, through the same stages
+# (resizing, development, tiling) but at a reduced resolution (all sizes are multiplied by "preview_scale"), into a
+# separate root directory. The demosaicing is replaced by either:
+#   "half_size" --> the fast demosaicing of rawtherapee, followed by its own (down) resizing
+#   "embedded"  --> the JPEG preview embedded in the RAW file (no demosaicing at all, the preview being already
+#                   rendered by the camera); RAW files without embedded preview fall back to "half_size".
+# Note that the development parameters given in pixels (e.g. the USM radius) are not scaled. None for the normal
+# generation.
+PREVIEW_MODES = [None, "half_size", "embedded"]
+preview_mode = None
+preview_nb_images = 20
+preview_scale = 0.25
 
 # Remove all files or not
 bool_remove_beginning = True
-remove_dir = ["out_dir", "out_dir_tif", "tmp_dir", "profile_used_dir", "out_dir_multisplit"]
+remove_dir = ["out_dir", "out_dir_tif", "tmp_dir", "profile_used_dir", "out_dir_multisplit", "log_dir", "stamp_dir",
+              "export_dir", "param_store_dir"]
+# Instead of being removed at the beginning (which, for millions of files, takes a long time before any RAW image is
+# processed), the directories of remove_dir are replaced: the run writes into new "versioned" directories, which are
+# promoted (their usual path becomes a link to them) when the run is over, and the old ones are removed by a background
+# process with a low priority (see "output_versions.py"). The list of the profiles, the manifest and the tile index are
+# versioned and promoted along with them.
+bool_versioned_outputs = True
+# Incremental rebuild: nothing is removed at the beginning and, for each image, only the stages whose inputs or
+# parameters changed since the previous run are carried out again (see "stage_cache.py"); e.g. changing the JPEG QF
+# only re-encodes the developed TIFF images. The stamps of the stages are stored by every run, but the resized and
+# developed TIFF images are only kept by an incremental run: after a normal run, an incremental one skips the images
+# whose outputs are up to date and, for the others, starts again from the demosaicing. Hence, set this boolean from
+# the first run of a base that is likely to be rebuilt.
+bool_incremental = False
 
 # Complete path where the script is run
 real_path = Path(os.path.dirname(os.path.realpath(__file__)))
@@ -42,6 +89,9 @@ hd_path = "/media/yiouki/HD_Hugo/DataBase/"
 # we start with the main root directory, in which everything will be output:
 config_path = dict(root="JPEG_Bases")
 # config_path = dict(root=os.path.join(hd_path, "DB_RealComplete", "Dell_Bases", baseName))
+# (the preview mode never writes into the root of the base itself)
+if preview_mode is not None:
+    config_path["root"] += "_preview"
 
 # where RAW images should be
 # raw_folder_path_parent = os.path.join(real_path, "RAW_bases")
@@ -59,13 +109,124 @@ config_path["out_dir_tif"] = config_path["root"] + "/" + baseName + "_TIFF_1024x
 # where intermediate (temporary) images will be stored:
 config_path["tmp_dir"] = config_path["root"] + "/TIFF_tmp"
 # important, direcroty in which "profiles" that defines the development parameters will be written for each and every
-# image:
+# image (only if bool_keep_profiles, see below):
 config_path["profile_used_dir"] = config_path["root"] + "/profiles_applied"
+# where the development parameters of all images are stored, in a columnar store that can be queried (see
+# "param_store.py"):
+config_path["param_store_dir"] = config_path["root"] + "/dev_params"
 # initial profiles, for demosaicing only:
 config_path["dem_profile_dir"] = "demProfiles"
+# where the hashes of the stages already carried out are stored for each image (for the incremental rebuild):
+config_path["stamp_dir"] = config_path["root"] + "/stage_stamps"
+# where the packed export of the tiles (for training data loaders) is written:
+config_path["export_dir"] = config_path["root"] + "/packed_export"
+# where the output of rawtherapee and x3f_extract is logged (one file per image and per stage, kept only on failure):
+config_path["log_dir"] = config_path["root"] + "/tool_logs"
+# demosaicing profile of the "half_size" preview mode (the fast demosaicing profile with a resizing enabled):
+preview_dem_profile_path = config_path["root"] + "/preview_dem.pp3"
 
 # File in which the randomly generated development parameters are output for loging purpose:
 backup_file_path = config_path["root"] + "/list_img_profiles.txt"
+# The development parameters of every image are stored in the parameter store, the pp3 profile used by rawtherapee is
+# only rendered (in the temporary directory) right before the development and removed afterwards; set this boolean to
+# keep the profiles of all images in "profile_used_dir" instead.
+bool_keep_profiles = False
+dev_store = paramStore(config_path["param_store_dir"], DEV_PARAM_SCHEMA)
+# Manifest of the outputs (path, size, content hash, source RAW, plan hash), written during the generation and used to
+# verify a base (completeness, corrupt or stale outputs) with: python Base_Generator.py verify (see "manifest.py");
+# the problems found are listed in the verification report.
+bool_manifest = True
+manifest_path = config_path["root"] + "/manifest.jsonl"
+verify_report_path = config_path["root"] + "/verify_report.csv"
+output_manifest = outputManifest(manifest_path)
+# File in which the edge density (score) and the weight of every tile is output, when tiles are scored (CSV); note that
+# for an incremental rebuild, the rows of the tiles compressed again are appended (the last ones are up to date):
+tile_index_path = config_path["root"] + "/tile_index.csv"
+
+# Some X3F files can only be read by x3f_extract; we learn, per camera model, which decoder works (see
+# "decoder_routing.py") so that later images go straight to it. All decoders are tried again every
+# "decoder_reprobe_every" images. Note that this file is (on purpose) never removed at the beginning of the script.
+bool_decoder_routing = True
+decoder_routing_path = config_path["root"] + "/decoder_routing.json"
+decoder_reprobe_every = 50
+x3f_router = decoderRouter(decoder_routing_path, reprobe_every=decoder_reprobe_every)
+
+# External tools are run with a timeout of "base" seconds plus "per_mb" seconds per MB of input (at most "max"
+# seconds) and retried at most "max_retries" times; RAW images for which a tool always hangs are added to a quarantine
+# list, kept from one run to the next (see "external_tools.py"), and skipped.
+tool_timeout = dict(base=120, per_mb=10, max=1800)
+tool_max_retries = 1
+quarantine_path = config_path["root"] + "/quarantine.json"
+tool_runner = toolRunner(config_path["log_dir"], quarantine_path, timeout_base=tool_timeout["base"],
+                         timeout_per_mb=tool_timeout["per_mb"], timeout_max=tool_timeout["max"],
+                         max_retries=tool_max_retries)
+
+# Live counters (images done per stage and per RAW base, failures, images/minute, ETA and worker utilization) are
+# published, without scanning any directory, in a Prometheus textfile and, if a port is set, on
+# http://127.0.0.1:<port>/metrics (see "progress_metrics.py")
+bool_live_metrics = True
+metrics_spool_path = config_path["root"] + "/metrics_events.jsonl"
+metrics_textfile_path = config_path["root"] + "/metrics.prom"
+metrics_http_port = None
+
+stamp_cache = stageCache(config_path["stamp_dir"])
+
+# The RAW bases overlap (the same scene re-hosted in several collections, possibly under another name): before any
+# conversion, RAW images are fingerprinted (hash of their content and, for near-duplicates, dHash of their embedded
+# preview, see "raw_dedup.py") and only the first occurrence of each file, in the order of config_path["raw_dir"], is
+# converted. The fingerprints are kept from one run to the next (this index is never removed at the beginning) and the
+# duplicates found are listed in the report. Near-duplicates (dHash distance at most "dedup_max_distance") are only
+# reported: two different shots of a burst have almost the same preview, hence they are dropped only if
+# dedup_drop_near_duplicates is set (e.g. after checking the report).
+bool_dedup_raw = True
+dedup_near_duplicates = True
+dedup_drop_near_duplicates = False
+dedup_max_distance = 3
+dedup_index_path = config_path["root"] + "/raw_fingerprints.json"
+dedup_report_path = config_path["root"] + "/raw_duplicates.csv"
+
+# RAM budget (in GB) for the memory hungry stages (demosaicing and resizing) of all workers: before such a stage, each
+# worker estimates its peak memory from the image size and waits until it fits in the budget; the estimates are
+# refined with the peak RSS measured for each stage (see "memory_budget.py"). When a budget is set, the number of
+# workers is no longer limited to 3/4 of the cores. None disables the admission control.
+memory_budget_gb = None
+memory_ledger_path = config_path["root"] + "/memory_ledger.json"
+memory_estimates_path = config_path["root"] + "/memory_estimates.json"
+memory_budget = memoryBudget(memory_budget_gb * 2 ** 30, memory_ledger_path, memory_estimates_path) \
+    if memory_budget_gb is not None else None
+
+# Packed export: the tiles of one version ("multicrop", or the name of a fan-out version such as "fanout_QF75_256x256",
+# see fanout_stage) are also streamed into a single preallocated memory-mappable array of pixels ("tiles.npy") and / or
+# a single blob of JPEG files, along with a metadata table (source RAW, base, tile, QF and development parameters), so
+# that a training data loader reads batches of tiles without opening any file (see "packed_export.py"). Pixels are only
+# exported for a fixed tile size (config_process["tile_size"] or the tile size of the fan-out version). None disables
+# the export.
+packed_export_version = None
+packed_export_pixels = True
+packed_export_jpeg = True
+packed_export = packedExport(config_path["export_dir"], store_pixels=packed_export_pixels,
+                             store_jpeg=packed_export_jpeg)
+
+# Read-ahead of the RAW images, stored on a slow (external) disk and read in a random order by the workers: a thread of
+# the main process copies the next images, "prefetch_window" at a time in the order of the files on the disk, into a
+# staging directory on a fast (local SSD or RAM) disk, with at most "prefetch_max_gb" GB staged at any time; the
+# workers demosaic the staged copy when it is ready, and remove it right after (see "raw_prefetch.py"). The hit rate
+# and the read bandwidth are published with the live metrics.
+bool_prefetch_raw = True
+prefetch_staging_dir = config_path["root"] + "/raw_staging"
+# prefetch_staging_dir = "/dev/shm/jpeg_base_raw_staging"
+prefetch_max_gb = 4
+prefetch_window = 64
+
+# Orchestration of the conversions: "joblib" runs each conversion in its own worker process (numCores of them, see the
+# end of the script), which mostly waits for rawtherapee; "asyncio" runs them all from a single coordinator process that
+# drives up to "async_max_tools" external tools at the same time and hands the CPU heavy stages (resizing, edge crop,
+# tiling and JPEG compression) to a small pool of "async_cpu_workers" processes, hence far fewer Python interpreters
+# (with NumPy, SciPy ... loaded) are alive. "async_max_images" is the number of images being converted at once.
+orchestration = "joblib"
+async_max_tools = multiprocessing.cpu_count()
+async_cpu_workers = max(1, multiprocessing.cpu_count() // 4)
+async_max_images = 2 * async_max_tools
 
 # Second main variable, the "config_process", that defines, for ALL development parameters, the range in which
 # those are picked. This configuration of the development process is quite "coarse grain"; More specification on
@@ -75,6 +236,27 @@ config_process = dict()
 # otherwise, randomly select a subset of images
 config_process["number_of_output_images"] = 100000000
 config_process["jpg_per_raw"] = 16
+# Tiling used by the multi crop (see "tiling.py"): size of the tiles (if None, the image is split into a grid of
+# sqrt(jpg_per_raw) x sqrt(jpg_per_raw) tiles), shift between two tiles (if None, equal to the tile size, i.e. no
+# overlap) and policy for the tiles that do not fit in the image ("drop", "shift" or "pad")
+config_process["tile_size"] = None
+config_process["tile_stride"] = None
+config_process["tile_edge_policy"] = "drop"
+# The tiles (views of the developed image) are handed to the JPEG compression, and streamed into the packed export, by
+# batches of "tile_batch_size" tiles
+config_process["tile_batch_size"] = 16
+# Content based filtering of the tiles: each tile is scored by its edge density, i.e. the fraction of its pixels
+# detected as edges by the detector of the smart crop (see imProc.edge_map, with the threshold "tile_edge_threshold"),
+# computed once per image and summed per tile through an integral image. Tiles whose density is below
+# "tile_min_edge_density" (flat sky, black frames ...) are either not compressed ("tile_filter_mode" = "drop") or
+# kept with a weight lower than 1, proportional to their density but at least "tile_min_weight" ("weight"); the scores
+# and weights of all tiles are recorded in the tile index.
+TILE_FILTER_MODES = ["drop", "weight"]
+config_process["tile_scoring"] = False
+config_process["tile_edge_threshold"] = 1.5
+config_process["tile_min_edge_density"] = 0.01
+config_process["tile_filter_mode"] = "drop"
+config_process["tile_min_weight"] = 0.01
 # Probability of using sharpening
 config_process["prob_shr"] = 1
 # Probability of using unsharpening mask
@@ -110,6 +292,15 @@ config_process["resize_factor_upperBound"] = 1.30
 # QF
 config_process["jpeg_qf"] = 75
 config_process["jpeg_qf_probabilities"] = 1
+# Fan-out: from each developed image, several versions are produced, each one with its JPEG quality factor "qf" and its
+# tile size "tile_size" (None for the whole image) and written into its own output tree (see fanout_out_dir). Hence,
+# the demosaicing and the development are carried out once per RAW image instead of once per version. When set, those
+# versions replace the "out_dir" and "out_dir_multisplit" outputs.
+config_process["fanout"] = None
+# config_process["fanout"] = [dict(qf=75, tile_size=256), dict(qf=90, tile_size=256), dict(qf=95, tile_size=256),
+#                             dict(qf=75, tile_size=512), dict(qf=75, tile_size=None)]
+# Each version may also set its own "stride" and "edge_policy" (the multi crop ones being used otherwise), e.g.
+# dict(qf=75, tile_size=256, stride=128, edge_policy="shift") for tiles overlapping by half.
 # config_process["jpeg_qf"] = np.arange(60, 100 + 1)
 # Probabilities corresponding of QF
 # config_process["jpeg_qf_probabilities"] = [0.0030, 0, 0, 0, 0, 0.0010, 0, 0, 0, 0.0010, 0.0070, 0.0020, 0.0010, 0,
@@ -143,13 +334,35 @@ config_process["demosaicing_probabilities"] = dem_probs
 # **************************#
 # MAIN conversion function #
 # **************************#
+# The conversion of an image is written as a generator of "steps" (see tool_step and cpu_step): it yields every call to
+# an external tool and every CPU heavy stage, and receives their result, so that the same conversion can be driven
+# either in a joblib worker, which runs the steps one after the other (From_RAW_to_JPG), or by the coordinator of the
+# asyncio orchestration, which interleaves the steps of many images (From_RAW_to_JPG_async).
 def From_RAW_to_JPG(RAWimageName, RAWpath):
+    steps = conversion_steps(RAWimageName, RAWpath, claim_raw(RAWimageName, RAWpath))
+    converted = False
+    try:
+        step = next(steps)
+        while True:
+            step = steps.send(run_step(step))
+    except StopIteration as stop:
+        converted = bool(stop.value)
+    finally:
+        release_raw(RAWimageName, RAWpath)
+    return converted
+
+
+# RAWreadPath is the path from which the RAW image is read, if not from the RAW base (see claim_raw); returns whether
+# the image has been converted, i.e. not skipped (quarantined, already processed or up to date)
+def conversion_steps(RAWimageName, RAWpath, RAWreadPath=None):
     # Here we start 1) splitting image path by filename and extension
+    raw_folder = os.path.split(RAWpath)[1]
     imageBaseName = os.path.splitext(RAWimageName)[0]
     imageRawExtension = os.path.splitext(RAWimageName)[1]
 
-    # First check to modify the TIFimagePath in order to develop more than only one image per RAW
-    if os.path.exists(config_path["profile_used_dir"] + "/" + imageBaseName + ".pp3"):
+    # First check to modify the TIFimagePath in order to develop more than only one image per RAW (this does not
+    # apply to an incremental rebuild, in which the existing images are updated instead)
+    if not bool_incremental and dev_store.contains(imageBaseName):
         counter = 0
         # print("Reference: " + imageBaseName)
         for complete_name in os.listdir(config_path["out_dir"]):
@@ -166,188 +379,177 @@ def From_RAW_to_JPG(RAWimageName, RAWpath):
     TIFimage2Path = os.path.join(config_path["tmp_dir"], imageBaseName + "_tmp2.tif")
     TIFimage3Path = os.path.join(config_path["out_dir_tif"], imageBaseName + ".tif")
     RAWimagePath = os.path.join(RAWpath, imageBaseName.split('_')[0] + imageRawExtension)
-    ImageProfilePath = os.path.join(config_path["profile_used_dir"], imageBaseName + ".pp3")
+    ImageProfilePath = os.path.join(config_path["profile_used_dir"] if bool_keep_profiles else config_path["tmp_dir"],
+                                    imageBaseName + ".pp3")
+    # All JPEG in same folder but different database
+    jpeg_path = os.path.join(config_path["out_dir"], raw_folder)
+    JPEGimagePath = os.path.join(jpeg_path, imageBaseName + ".jpg")
+    # Save JPEG in different folder (each RAW folder have 16 JPEG images)
+    jpeg_mutlicrop_path = os.path.join(config_path["out_dir_multisplit"], raw_folder)
     print("Converting Image " + RAWimagePath)
 
-    if bool_random_dev:
-        # We create, for each and every images, a random generator that will be used to create (randomly) a development
-        # process file. To ensure the randomness and reproducibility of the development process, we propose to seed
-        # each generator by the MD5 hashsum of image filename To generate several version of the same dataset you can
-        # use, for instance, the following commands (which hash a value from system time to generate a random seed for
-        # every image)
-        # imageSeed=int.from_bytes(md5( (round(time.time() * 100000)**2).to_bytes(32, byteorder='big') ).digest(),
-        # 'big') % 2**32
-        imageSeed = int.from_bytes(md5(bytes(imageBaseName, 'utf-8')).digest(), 'big') % 2 ** 32
-        # imageSeed = None
-        rg = devRandomGenerator(config_process["jpeg_qf"],
-                                config_process["jpeg_qf_probabilities"],
-                                config_process["crop_size"],
-                                config_process["demosaicing"],
-                                config_process["demosaicing_probabilities"],
-                                config_process["resize_kernel"],
-                                config_process["resize_kernel_prob"],
-                                seed=imageSeed,
-                                resize_size=config_process["resize_size"])
-    else:
-        rg = devFixGenerator(
-            config_process["jpeg_qf"],
-            config_process["resize_size"],
-            config_process["demosaicing"]
-        )
+    if tool_runner.is_quarantined(RAWimagePath):
+        print("[WARNING] Image " + RAWimagePath + " is quarantined (external tool hanging): skipped")
+        return False
 
-    # The very first step consists in generating a random development file for the given image ; thus, if such a file
-    # exists, the associated image has already been processed. This is used to allows a cheap, yet efficient
-    # parallelization by simply launching several time the same conversion script (see Section "Parallelization" in
-    # the pdf documentation)
-    if not os.path.exists(ImageProfilePath):
-        # INITIALIZATION: random selection of development / processing parameters and storing into a pp3 file
-        DevList = {
-            "name": imageBaseName,
-            "dem": rg.dem["dem_algorithm"](),
-            "subsampling_type": rg.r.choice([0, 1, 2], p=[config_process["prob_resize_and_crop"],
-                                                          config_process["prob_resize_only"],
-                                                          config_process["prob_crop_only"]]),
-            "resize_kernel": rg.resize_kernel["kernel"](),
-            "resize_weight": rg.resize_weight["factor"](),
-            "crop_size": rg.crop["size"](),
-            "qf": rg.QF["QF"]()
-        }
-        if bool_random_dev:
-            DevList["choice"] = {
-                "usm": rg.r.binomial(1, config_process["prob_usm"]),
-                "denois": rg.r.binomial(1, config_process["prob_denoise"]),
-                "usm_if_denois": rg.r.binomial(1, config_process["prob_usm_if_denoise"]),
-                "denois_if_usm": rg.r.binomial(1, config_process["prob_denoise_if_usm"])
-            }
-        else:
-            DevList["choice"] = {
-                "shr": config_process["prob_usm"],
-                "usm": config_process["prob_usm"],
-                "rld": config_process["prob_usm"],
-                "denois": config_process["prob_denoise"],
-                "usm_if_denois": config_process["prob_usm_if_denoise"],
-                "denois_if_usm": config_process["prob_denoise_if_usm"]
-            }
-
-        dumpFile = open("/tmp/dumpOutPut.txt", "wb")
-        # this file is used to dump output from rawtherapee and x3f_extract which are quite verbose and cannot be
-        # used in quiet mode :(
-        # FIRST STEP: APPLYING DEMOSAICING ! Note that, we used rawtherapee version 5.7 which seems, as opposed to
-        # version 5.3, to handle efficiently X3F Sigma foveon trichromatic sensor
-        if imageRawExtension.upper() == ".X3F":
-            # However, some X3F images still cannot be processed with rawtherapee; for this reason we try first to
-            # apply rawtherappe; if it fails, we call x3f_extractor executable.
-            print("[WARNING] Sigma Foveon X3F raw file ! Trying RawTherapee")
-            # This is a typical use of call to execute the rawtherapee-cli command (note that the output are dumped
-            # to /tmp/ )
-            call(["rawtherapee-cli", "-a", "-q", "-t", "-b16", "-o", TIFimagePath, "-p",
-                  os.path.join(config_path["dem_profile_dir"], DevList["dem"]), "-c", RAWimagePath], stdout=dumpFile,
-                 stderr=dumpFile)
-            # This is the "if rawtherapee fails" which is tested as "if not image file is generated"
-            if not os.path.exists(TIFimagePath):
-                # This is a typical use of binary x3f_extract to dump tiff data from X3F file (note that the output
-                # are dumped to /tmp/ )
-                call(["./x3f_extract", "-q", "-tiff", "-no-denoise", "-no-sgain", RAWimagePath], stdout=dumpFile,
-                     stderr=dumpFile)
-                # This script automatically write output image into the same directory, we move this file to match
-                # TIFimagePath variable
-                shutil.move(os.path.join(RAWimagePath + ".tif"), TIFimagePath)
-            if not os.path.exists(TIFimagePath):
-                print("[ERROR] neither rawtherapee nor x3f_extract managed to read this file! Are you sure it is not "
-                      "corrupted ?!?")
-                # if not X3F raw image files, we call also rawtherapee
-
-        # if not X3F raw image files, we call also rawtherapee
-        else:
-            call(["rawtherapee-cli", "-a", "-q", "-t", "-b16", "-o", TIFimagePath, "-p",
-                  os.path.join(config_path["dem_profile_dir"], DevList["dem"]), "-c", RAWimagePath],
-                 stdout=dumpFile, stderr=dumpFile)
+    # The very first step consists in generating a random development (stored in the parameter store) for the given
+    # image ; thus, if such a development exists, the associated image has already been processed. This is used to
+    # allows a cheap, yet efficient parallelization by simply launching several time the same conversion script (see
+    # Section "Parallelization" in the pdf documentation). For an incremental rebuild, the stamps of each stage decide
+    # instead what has to be done.
+    if bool_incremental or not dev_store.contains(imageBaseName):
+        # INITIALIZATION: random selection of development / processing parameters (stored into the parameter store
+        # only once the image is developed, so that an image whose processing failed is processed again)
+        rg, DevList, profile_text = draw_development(imageBaseName)
+        profile_md5 = md5(profile_text.encode("utf-8")).hexdigest()
+
+        # Then, we decide which stages have to be run: a stage is run if its output is needed and not "fresh", i.e.
+        # not already produced from the same inputs and parameters (see "stage_cache.py"); without incremental
+        # rebuild, every stage is run (and stamped, for a later incremental rebuild).
+        hashes = image_stage_hashes(DevList, RAWimagePath, profile_md5)
+        stamps = stamp_cache.load(imageBaseName) if bool_incremental else {}
+
+        def fresh(stage, outputs):
+            return bool_incremental and stamp_cache.is_fresh(stamps, stage, hashes[stage], outputs)
+
+        fanout_variants = config_process["fanout"] if config_process["fanout"] is not None else []
+        run_fanout = [variant for variant in fanout_variants if not fresh(fanout_stage(variant), None)]
+        run_multicrop = bool_multicrop and not fanout_variants and not fresh("multicrop", None)
+        run_encode = not fanout_variants and not fresh("encode", [JPEGimagePath])
+        run_develop = (run_encode or run_multicrop or run_fanout) and not fresh("develop", [TIFimage3Path])
+        run_resize = run_develop and not fresh("resize", [TIFimage2Path])
+        run_demosaic = run_resize and not fresh("demosaic", [TIFimagePath])
+
+        # Note that the output from rawtherapee and x3f_extract, which are quite verbose and cannot be used in quiet
+        # mode :( , is logged in a file per image and per stage by tool_runner.
+        # FIRST STEP: APPLYING DEMOSAICING (see the function demosaicing)
+        if run_demosaic:
+            report_prefetch(RAWreadPath is not None)
+            yield from demosaicing(RAWimagePath, TIFimagePath, DevList["dem"], imageBaseName, RAWreadPath)
+            release_raw(RAWimageName, RAWpath)
+            report_stage("demosaic", raw_folder, os.path.exists(TIFimagePath))
+            if os.path.exists(TIFimagePath):
+                stamp_cache.store(imageBaseName, "demosaic", hashes["demosaic"])
         # Before moving forward, we ensure that the TIF image (resulting for demosaicing of RAW) does exist; indeed some
         # raw images files format cannot be read.
-        if os.path.exists(TIFimagePath):
+        if not run_resize or os.path.exists(TIFimagePath):
 
             # SECOND STEP: RESIZING and CROPPING
             # First of all, we carry out the resizing ; thi requires one extra parameter (the resizing factor) that
             # depends on the image size ;
-            # depends on the image size ;
             # To deal with this we call the resizing and get the factor as an output ....
-            DevList["subsampling_factor"] = imProc.image_randomize_resizing(TIFimagePath, TIFimage2Path,
-                                                                            DevList['crop_size'][0],
-                                                                            DevList['crop_size'][1],
-                                                                            subsampling_type=DevList[
-                                                                                'subsampling_type'],
-                                                                            kernel=DevList['resize_kernel'],
-                                                                            resize_weight=DevList['resize_weight'],
-                                                                            resize_factor_UB=config_process[
-                                                                                "resize_factor_upperBound"],
-                                                                            resize_size=config_process["resize_size"],
-                                                                            grayscale=bool_grayscale)
-
-            # ... Then, and only then, we can write dump the profiles of the image in the associated file.
-            if bool_random_dev:
-                rg.generate_random_RT_profile(
-                    imageDevList=DevList,
-                    outputPath=ImageProfilePath,
-                    backupfile=backup_file_path
-                )
+            if run_resize:
+                DevList["subsampling_factor"] = yield cpu_step(
+                    imProc.image_randomize_resizing,
+                    TIFimagePath, TIFimage2Path, preview_size(DevList['crop_size'][0]),
+                    preview_size(DevList['crop_size'][1]),
+                    memory=("resize", imProc.tiff_nb_pixels(TIFimagePath)),
+                    subsampling_type=DevList['subsampling_type'],
+                    kernel=DevList['resize_kernel'],
+                    resize_weight=DevList['resize_weight'],
+                    resize_factor_UB=config_process["resize_factor_upperBound"],
+                    resize_size=preview_size(config_process["resize_size"]),
+                    grayscale=bool_grayscale)
+                report_stage("resize", raw_folder, os.path.exists(TIFimage2Path))
+                if os.path.exists(TIFimage2Path):
+                    stamp_cache.store(imageBaseName, "resize", hashes["resize"],
+                                      subsampling_factor=DevList["subsampling_factor"])
+            # ... (or get it back from the stamp of the resizing when it is skipped)
             else:
-                rg.generate_fix_RT_profile(
-                    imageDevList=DevList,
-                    outputPath=ImageProfilePath,
-                    backupfile=backup_file_path,
-                    prob_usm_if_denoise=config_process["prob_usm_if_denoise"]
-                )
-
-            if os.path.exists(TIFimage2Path):
+                DevList["subsampling_factor"] = stamps["resize"]["subsampling_factor"] if "resize" in stamps else 0
+
+            if not run_develop or os.path.exists(TIFimage2Path):
                 # FORTH (and main) STEP: generating processing pipeline file and using rawtherapee
-                call(["rawtherapee-cli", "-a", "-q", "-t", "-b8", "-o", TIFimage3Path, "-p", ImageProfilePath, "-c",
-                      TIFimage2Path], stdout=dumpFile, stderr=dumpFile)
-
-                if os.path.exists(TIFimage3Path):  # All JPEG in same folder but different database
-                    raw_folder = os.path.split(RAWpath)[1]
-                    if bool_multicrop:  # and bool_random_dev is False:
-                        # Split the TIFF in x TIFF of 256x256
-                        tif_multicrop_path = multi_crop(TIFimage3Path, config_process["jpg_per_raw"],
-                                                        grayscale=bool_grayscale)
-
-                        # Save JPEG in different folder (each RAW folder have 16 JPEG images)
-                        jpeg_mutlicrop_path = os.path.join(config_path["out_dir_multisplit"], raw_folder)
-                        if not os.path.exists(jpeg_mutlicrop_path):
-                            os.makedirs(jpeg_mutlicrop_path, 0o755)
-                        for i in range(config_process["jpg_per_raw"]):
-                            imProc.jpeg_compression(
-                                infile=os.path.join(tif_multicrop_path, imageBaseName + "_" + str(i + 1) + ".tif"),
-                                outpath=os.path.join(jpeg_mutlicrop_path, imageBaseName + "_" + str(i + 1) + ".jpg"),
-                                qf=DevList["qf"])
+                if run_develop:
+                    with open(ImageProfilePath, "w") as profile_file:
+                        profile_file.write(profile_text)
+                    completed = yield tool_step("develop", ["rawtherapee-cli", "-a", "-q", "-t", "-b8", "-o",
+                                                            TIFimage3Path, "-p", ImageProfilePath, "-c", TIFimage2Path],
+                                                TIFimage2Path, imageBaseName, RAWimagePath)
+                    if not completed:
+                        tool_runner.quarantine(RAWimagePath, "develop", "timeout")
+                    report_stage("develop", raw_folder, os.path.exists(TIFimage3Path))
+                    if not bool_keep_profiles:
+                        remove_files([ImageProfilePath])
+                    if os.path.exists(TIFimage3Path):
+                        stamp_cache.store(imageBaseName, "develop", hashes["develop"])
+
+                # ... Then, and only then, we can store the parameters (with the resizing factor) of the developed image
+                # and log its profile in the associated file.
+                if not run_develop or os.path.exists(TIFimage3Path):
+                    dev_store.put(dev_params_row(DevList, raw_folder, RAWimageName, profile_md5))
+                    if run_develop:
+                        rg.write_backup_line(DevList, backup_file_path)
+
+                if not (run_encode or run_multicrop or run_fanout) or os.path.exists(TIFimage3Path):
+                    # FAN-OUT: all the versions are produced from the developed image, loaded only once
+                    fanout_success = True
+                    # outputs written, as (stage, hash of the stage, paths), for the manifest
+                    new_outputs = []
+                    if run_fanout:
+                        fanout_outputs = yield cpu_step(fanout_compression, TIFimage3Path, imageBaseName, raw_folder,
+                                                        run_fanout, packed_export_fields(DevList, RAWimagePath,
+                                                                                         raw_folder))
+                        for variant in run_fanout:
+                            outputs = fanout_outputs[fanout_stage(variant)]
+                            fanout_success = fanout_success and outputs is not None
+                            if outputs is not None:
+                                new_outputs.append((fanout_stage(variant), hashes[fanout_stage(variant)], outputs))
+                            if outputs is not None:
+                                stamp_cache.store(imageBaseName, fanout_stage(variant), hashes[fanout_stage(variant)],
+                                                  outputs=outputs)
+
+                    if run_multicrop:  # and bool_random_dev is False:
+                        # Split the developed image in tiles (of 256x256 for 16 tiles of a 1024x1024 image), directly
+                        # handed to the JPEG compression (without any intermediate TIFF image)
+                        multicrop_outputs = yield cpu_step(multicrop_compression, TIFimage3Path, imageBaseName,
+                                                           raw_folder, jpeg_mutlicrop_path, DevList["qf"],
+                                                           packed_export_fields(DevList, RAWimagePath, raw_folder))
+                        multicrop_success = all(os.path.exists(path) for path in multicrop_outputs)
+                        report_stage("multicrop", raw_folder, multicrop_success)
+                        if multicrop_success:
+                            new_outputs.append(("multicrop", hashes["multicrop"], multicrop_outputs))
+                        if multicrop_success:
+                            stamp_cache.store(imageBaseName, "multicrop", hashes["multicrop"],
+                                              outputs=multicrop_outputs)
 
                     # LAST STEP: (mere) jpeg compression
-                    jpeg_path = os.path.join(config_path["out_dir"], raw_folder)
-                    if not os.path.exists(jpeg_path):
-                        os.makedirs(jpeg_path, 0o755)
-                    imProc.jpeg_compression(infile=TIFimage3Path,
-                                            outpath=os.path.join(jpeg_path, imageBaseName + ".jpg"),
-                                            qf=DevList["qf"])
-
-                    # Eventually, we double check that the associated JPEG image exists;
+                    if run_encode:
+                        os.makedirs(jpeg_path, 0o755, exist_ok=True)
+                        yield cpu_step(imProc.jpeg_compression, infile=TIFimage3Path, outpath=JPEGimagePath,
+                                       qf=DevList["qf"])
+                        report_stage("encode", raw_folder, os.path.exists(JPEGimagePath))
+                        new_outputs.append(("encode", hashes["encode"], [JPEGimagePath]))
+                        if os.path.exists(JPEGimagePath):
+                            stamp_cache.store(imageBaseName, "encode", hashes["encode"])
+
+                    if keepUncompressed and run_develop:
+                        new_outputs.append(("develop", hashes["develop"], [TIFimage3Path]))
+                    # (hashing the outputs, still in the page cache, is done along with the CPU heavy stages)
+                    if bool_manifest and new_outputs:
+                        yield cpu_step(output_manifest.record, new_outputs, RAWimagePath, imageBaseName, profile_md5)
+
+                    # Eventually, we double check that the associated JPEG image (or all the versions) exists;
                     # if not we keep the TIF temporary files for backup and debugging
-                    if os.path.exists(os.path.join(jpeg_path, imageBaseName + ".jpg")):
+                    conversion_success = fanout_success if fanout_variants else os.path.exists(JPEGimagePath)
+                    report_stage("done", raw_folder, conversion_success)
+                    if conversion_success:
+                        tool_runner.clean_logs(imageBaseName, ["demosaic_rawtherapee", "demosaic_x3f", "develop"])
+                        # For an incremental rebuild, the resized and developed TIFF images are kept (they are the
+                        # inputs of the stages that are the most likely to be rebuilt); only the (large) demosaiced
+                        # image is removed
+                        if bool_incremental:
+                            remove_files([TIFimagePath])
+                            print("[SUCCESS] Image ", imageBaseName + ".jpg", " up to date ")
                         # We can either keep tiff (uncompressed) image
-                        if keepUncompressed:
-                            call(["rm", TIFimagePath, TIFimage2Path])
+                        elif keepUncompressed:
+                            remove_files([TIFimagePath, TIFimage2Path])
                             print("[SUCCESS] Images ", imageBaseName + ".tif and", imageBaseName + ".jpg",
                                   " Converted successfully ")
                         # or keep only the jpg, in such case, we remove ALL itermediate images
                         else:
-                            tif_multicrop_folder_path = os.path.join(
-                                config_path["out_dir_tif"],
-                                "Multi_Crop",
-                                imageBaseName)
-                            if os.path.exists(tif_multicrop_folder_path) \
-                                    and len(os.listdir(tif_multicrop_folder_path)) == config_process["jpg_per_raw"]:
-                                shutil.rmtree(tif_multicrop_folder_path)
-
                             # When the JPEG is saved, delete all TIF corresponding to this image
-                            call(["rm", TIFimagePath, TIFimage2Path, TIFimage3Path])
+                            remove_files([TIFimagePath, TIFimage2Path, TIFimage3Path])
                             print("[SUCCESS] Image ", imageBaseName + ".jpg", " Converted successdully ")
 
                     # Print out possible causes that lead not to develop the given RAW images, for logging.
@@ -359,66 +561,731 @@ def From_RAW_to_JPG(RAWimageName, RAWpath):
                 print("[ERROR] SUBSAMPLING FAILED FOR" + RAWimagePath)
         else:
             print("[ERROR] Image " + RAWimagePath + " can hardly be converted to TIFF: skipped")
+        return bool(run_encode or run_multicrop or run_fanout)
     else:
         print("[WARNING] Image: " + imageBaseName + ".jpg already processed: skipped ")
+        return False
 
 
-def multi_crop(initial_path, nb_images, grayscale=False):
-    path = os.path.splitext(initial_path)[0]
-    raw_image = str.split(path, '/')[-1]
-    path = os.path.join(*str.split(path, '/')[1:-1])
-    # entire_path = os.path.join("/", path, "Multi_Crop", raw_image)
-    entire_path = os.path.join("./JPEG_Bases/Real_Base_3_MultiSplit_JPG_256x256_QF75", "Multi_Crop", raw_image)
-    if not os.path.exists(entire_path):
-        os.makedirs(entire_path, 0o755)
+# **************************#
+# Development parameters of an image #
+# **************************#
+# The parameters are drawn from a generator of the image only, hence they are the same whenever they are drawn again
+# with the same config_process; returns the generator, the parameters and the rendered (pp3) profile
+def draw_development(imageBaseName):
+    if bool_random_dev:
+        # We create, for each and every images, a random generator that will be used to create (randomly) a development
+        # process file. To ensure the randomness and reproducibility of the development process, we propose to seed
+        # each generator by the MD5 hashsum of image filename To generate several version of the same dataset you can
+        # use, for instance, the following commands (which hash a value from system time to generate a random seed for
+        # every image)
+        # imageSeed=int.from_bytes(md5( (round(time.time() * 100000)**2).to_bytes(32, byteorder='big') ).digest(),
+        # 'big') % 2**32
+        imageSeed = int.from_bytes(md5(bytes(imageBaseName, 'utf-8')).digest(), 'big') % 2 ** 32
+        # imageSeed = None
+        rg = devRandomGenerator(config_process["jpeg_qf"],
+                                config_process["jpeg_qf_probabilities"],
+                                config_process["crop_size"],
+                                config_process["demosaicing"],
+                                config_process["demosaicing_probabilities"],
+                                config_process["resize_kernel"],
+                                config_process["resize_kernel_prob"],
+                                seed=imageSeed,
+                                resize_size=config_process["resize_size"],
+                                keyed_rng=bool_keyed_rng)
+    else:
+        rg = devFixGenerator(
+            config_process["jpeg_qf"],
+            config_process["resize_size"],
+            config_process["demosaicing"]
+        )
+
+    # INITIALIZATION: random selection of development / processing parameters
+    DevList = {
+        "name": imageBaseName,
+        "dem": rg.dem["dem_algorithm"](),
+        "subsampling_type": rg.stream("subsampling_type").choice([0, 1, 2],
+                                                                 p=[config_process["prob_resize_and_crop"],
+                                                                    config_process["prob_resize_only"],
+                                                                    config_process["prob_crop_only"]]),
+        "resize_kernel": rg.resize_kernel["kernel"](),
+        "resize_weight": rg.resize_weight["factor"](),
+        "crop_size": rg.crop["size"](),
+        "qf": rg.QF["QF"]()
+    }
+    if bool_random_dev:
+        DevList["choice"] = {
+            "usm": rg.stream("choice_usm").binomial(1, config_process["prob_usm"]),
+            "denois": rg.stream("choice_denoise").binomial(1, config_process["prob_denoise"]),
+            "usm_if_denois": rg.stream("choice_usm_if_denoise").binomial(1, config_process["prob_usm_if_denoise"]),
+            "denois_if_usm": rg.stream("choice_denoise_if_usm").binomial(1, config_process["prob_denoise_if_usm"])
+        }
+    else:
+        DevList["choice"] = {
+            "shr": config_process["prob_usm"],
+            "usm": config_process["prob_usm"],
+            "rld": config_process["prob_usm"],
+            "denois": config_process["prob_denoise"],
+            "usm_if_denois": config_process["prob_usm_if_denoise"],
+            "denois_if_usm": config_process["prob_denoise_if_usm"]
+        }
 
-    if grayscale:
-        im = tifffile.imread(initial_path)[:, :, 0]
+    # The profile of the image is picked and stored first (it does not depend on the resizing), the resizing factor
+    # is stored, and the profile logged, later on. The pp3 file is only rendered right before the development.
+    if bool_random_dev:
+        rg.generate_random_RT_profile(imageDevList=DevList, outputPath=None, backupfile=None)
     else:
-        im = tifffile.imread(initial_path)
+        rg.generate_fix_RT_profile(imageDevList=DevList, outputPath=None, backupfile=None,
+                                   prob_usm_if_denoise=config_process["prob_usm_if_denoise"])
+    return rg, DevList, rg.render_RT_profile(DevList["profile"])
 
-    img_width, img_height = im.shape[0:2]
 
-    step = np.sqrt(nb_images)
-    step_height = int(np.ceil(img_height / step))
-    step_width = int(np.ceil(img_width / step))
+# Hashes of the stages of an image, as they would be planned with the current configuration (for the verification of a
+# base, see "manifest.py"), or None if its RAW image cannot be read
+def current_plan_hashes(imageBaseName, RAWimagePath):
+    try:
+        _, DevList, profile_text = draw_development(imageBaseName)
+        return image_stage_hashes(DevList, RAWimagePath, md5(profile_text.encode("utf-8")).hexdigest())
+    except OSError:
+        return None
 
-    k = 0
-    imgs = []
-    for i in range(0, img_height, step_height):
-        for j in range(0, img_width, step_width):
-            left = i
-            top = j
-            right = min(img_width, i + step_width)
-            bottom = min(img_height, j + step_height)
 
-            if grayscale:
-                imagette = im[left:right, top:bottom]
-            else:
-                imagette = im[left:right, top:bottom, :]
+# **************************#
+# Hashes of the stages of an image (for incremental rebuild) #
+# **************************#
+# Each hash covers the hash of the previous stage (i.e. its input) and the parameters consumed by the stage.
+def image_stage_hashes(DevList, RAWimagePath, profile_md5):
+    hashes = dict()
+    dem_profile_path = os.path.join(config_path["dem_profile_dir"], DevList["dem"])
+    hashes["demosaic"] = stage_hash(None, {"raw": file_identity(RAWimagePath),
+                                           "dem_profile": file_content_hash(dem_profile_path)})
+    if preview_mode is not None:
+        hashes["demosaic"] = stage_hash(hashes["demosaic"], {"preview_mode": preview_mode,
+                                                             "preview_scale": preview_scale})
+    hashes["resize"] = stage_hash(hashes["demosaic"], {
+        "crop_size": [int(size) for size in DevList["crop_size"]],
+        "subsampling_type": DevList["subsampling_type"],
+        "resize_kernel": DevList["resize_kernel"],
+        "resize_weight": DevList["resize_weight"],
+        "resize_factor_upperBound": config_process["resize_factor_upperBound"],
+        "resize_size": config_process["resize_size"],
+        "grayscale": bool_grayscale})
+    hashes["develop"] = stage_hash(hashes["resize"], {"profile": profile_md5})
+    hashes["encode"] = stage_hash(hashes["develop"], {"qf": DevList["qf"]})
+    hashes["multicrop"] = stage_hash(hashes["develop"], {"qf": DevList["qf"],
+                                                         "jpg_per_raw": config_process["jpg_per_raw"],
+                                                         "tile_size": config_process["tile_size"],
+                                                         "tile_stride": config_process["tile_stride"],
+                                                         "tile_edge_policy": config_process["tile_edge_policy"],
+                                                         "tile_filter": tile_filter_params(),
+                                                         "grayscale": bool_grayscale})
+    for variant in (config_process["fanout"] if config_process["fanout"] is not None else []):
+        hashes[fanout_stage(variant)] = stage_hash(hashes["develop"], {"variant": variant,
+                                                                      "tile_stride": config_process["tile_stride"],
+                                                                      "tile_edge_policy": config_process[
+                                                                          "tile_edge_policy"],
+                                                                      "tile_filter": tile_filter_params(),
+                                                                      "grayscale": bool_grayscale})
+    return hashes
+
+
+# Row of the parameter store of a developed image
+def dev_params_row(DevList, raw_folder, RAWimageName, profile_md5):
+    row = dict(DevList["profile"])
+    row.update(name=DevList["name"], base=raw_folder, raw=RAWimageName, dem=DevList["dem"],
+               subsampling_type=DevList["subsampling_type"], resize_kernel=KERNEL_dict[DevList["resize_kernel"]],
+               subsampling_factor=DevList["subsampling_factor"], crop_height=DevList["crop_size"][0],
+               crop_width=DevList["crop_size"][1], qf=DevList["qf"], profile_md5=profile_md5)
+    return row
+
+
+def tile_filter_params():
+    if not config_process["tile_scoring"]:
+        return None
+    return [config_process["tile_edge_threshold"], config_process["tile_min_edge_density"],
+            config_process["tile_filter_mode"], config_process["tile_min_weight"]]
+
+
+# **************************#
+# Packed export of the tiles #
+# **************************#
+# Metadata of an image, shared by all its tiles, in the packed export (None when there is no export)
+def packed_export_fields(DevList, RAWimagePath, raw_folder):
+    if packed_export_version is None:
+        return None
+    fields = dict(base=raw_folder, image=DevList["name"], raw=RAWimagePath, dem=DevList["dem"],
+                  subsampling_type=DevList["subsampling_type"], resize_kernel=KERNEL_dict[DevList["resize_kernel"]],
+                  subsampling_factor=DevList["subsampling_factor"], crop_size=DevList["crop_size"][0])
+    fields.update(DevList["profile"])
+    return fields
+
+
+# Shape of the tiles of the exported version (None if their size is not fixed) and maximal number of tiles per image
+def packed_export_layout():
+    if packed_export_version == "multicrop":
+        tile_size, stride, edge_policy = config_process["tile_size"], config_process["tile_stride"], \
+            config_process["tile_edge_policy"]
+    else:
+        variant = [v for v in config_process["fanout"] if fanout_stage(v) == packed_export_version][0]
+        tile_size = variant["tile_size"]
+        stride = variant.get("stride", config_process["tile_stride"])
+        edge_policy = variant.get("edge_policy", config_process["tile_edge_policy"])
+        if tile_size is None:
+            return None, 1
+    if tile_size is None:
+        return None, config_process["jpg_per_raw"]
+    # The developed images are at most of the largest crop (or resizing) size
+    image_size = preview_size(max(max(config_process["crop_size"]), config_process["resize_size"] or 0))
+    tile_size, stride = preview_size(tile_size), preview_size(stride)
+    tile_shape = tiling.as_pair(tile_size) + (() if bool_grayscale else (3,))
+    return tile_shape, tiling.nb_tiles((image_size, image_size), tile_size, stride, edge_policy)
+
+
+# **************************#
+# Fan-out of a developed image into several versions #
+# **************************#
+def fanout_stage(variant):
+    if variant["tile_size"] is None:
+        return "fanout_QF{}_full".format(variant["qf"])
+    return "fanout_QF{}_{}x{}".format(variant["qf"], variant["tile_size"], variant["tile_size"])
+
+
+# Output tree of a version, named as the default outputs "out_dir" and "out_dir_multisplit" with a "Fanout" tag (so
+# that it never is one of them); it is registered in config_path at the beginning of the script (see
+# register_fanout_dirs), hence replaced and versioned as the directories of remove_dir
+def fanout_out_dir(variant):
+    return config_path[fanout_stage(variant)]
+
+
+def fanout_default_dir(variant):
+    if variant["tile_size"] is None:
+        return config_path["root"] + "/" + baseName + "_Fanout_JPG_QF{}".format(variant["qf"])
+    return config_path["root"] + "/" + baseName + "_Fanout_MultiSplit_JPG_{}x{}_QF{}".format(
+        variant["tile_size"], variant["tile_size"], variant["qf"])
 
+
+# Each version must have its own stage (QF and tile size) and its own output tree
+def check_fanout_variants():
+    variants = config_process["fanout"] if config_process["fanout"] is not None else []
+    stages = [fanout_stage(variant) for variant in variants]
+    if len(set(stages)) != len(stages):
+        raise ValueError("Several fan-out versions have the same QF and tile size: {}".format(stages))
+    for variant in variants:
+        if fanout_default_dir(variant) in config_path.values():
+            raise ValueError("The output tree {} of the fan-out version {} is already used".format(
+                fanout_default_dir(variant), fanout_stage(variant)))
+
+
+def register_fanout_dirs():
+    for variant in (config_process["fanout"] if config_process["fanout"] is not None else []):
+        config_path[fanout_stage(variant)] = fanout_default_dir(variant)
+        remove_dir.append(fanout_stage(variant))
+
+
+# Returns, for each version, the list of JPEG images written (or None if the compression failed); export_fields are the
+# metadata of the image for the packed export (see packed_export_fields)
+def fanout_compression(TIFimage3Path, imageBaseName, raw_folder, variants, export_fields=None):
+    im = load_developed_image(TIFimage3Path)
+    # The edge map used to score the tiles is computed once for all the versions
+    integral = tile_scoring_integral(im) if any(v["tile_size"] is not None for v in variants) else None
+    index_rows = []
+
+    outputs = dict()
+    for variant in variants:
+        out_path = os.path.join(fanout_out_dir(variant), raw_folder)
+        # (several workers may create it at the same time)
+        os.makedirs(out_path, 0o755, exist_ok=True)
+
+        if variant["tile_size"] is None:
+            whole_image = [(os.path.join(out_path, imageBaseName + ".jpg"), im,
+                            dict(tile=1, row=0, col=0, height=im.shape[0], width=im.shape[1], weight=1.))]
+            paths = compress_tiles(whole_image, variant["qf"], fanout_stage(variant), export_fields)
+        else:
+            # Tiles are mere views of the developed image (see "tiling.py"), hence cutting them again for each
+            # version costs nothing
+            tiles = tiling.iter_tiles(im, preview_size(variant["tile_size"]),
+                                      preview_size(variant.get("stride", config_process["tile_stride"])),
+                                      variant.get("edge_policy", config_process["tile_edge_policy"]))
+            paths = compress_tiles(selected_tiles(tiles, integral, out_path, imageBaseName, raw_folder,
+                                                  fanout_stage(variant), index_rows),
+                                   variant["qf"], fanout_stage(variant), export_fields)
+
+        success = all(os.path.exists(path) for path in paths)
+        report_stage(fanout_stage(variant), raw_folder, success)
+        outputs[fanout_stage(variant)] = paths if success else None
+    write_tile_index(index_rows)
+    return outputs
+
+
+# Multi crop: the developed image is split in tiles (of 256x256 for 16 tiles of a 1024x1024 image), directly handed to
+# the JPEG compression (without any intermediate TIFF image); returns the list of JPEG images written
+def multicrop_compression(TIFimage3Path, imageBaseName, raw_folder, jpeg_mutlicrop_path, qf, export_fields=None):
+    os.makedirs(jpeg_mutlicrop_path, 0o755, exist_ok=True)
+    im = load_developed_image(TIFimage3Path)
+    integral, index_rows = tile_scoring_integral(im), []
+    outputs = compress_tiles(selected_tiles(multi_crop(im, config_process["jpg_per_raw"]), integral,
+                                            jpeg_mutlicrop_path, imageBaseName, raw_folder, "multicrop", index_rows),
+                             qf, "multicrop", export_fields)
+    write_tile_index(index_rows)
+    return outputs
+
+
+# JPEG compression of the tiles given by selected_tiles, by batches; the tiles of the version packed_export_version are
+# also streamed, batch by batch, into the packed export. Returns the list of JPEG images written.
+def compress_tiles(tiles, qf, version, export_fields):
+    paths = []
+    for batch in tiling.batches(tiles, config_process["tile_batch_size"]):
+        exported = []
+        for path, tile, position in batch:
+            paths.append(path)
+            jpeg_data = imProc.jpeg_compression_array(tile, path, qf)
+            if export_fields is not None and version == packed_export_version and jpeg_data is not None:
+                exported.append((dict(export_fields, version=version, qf=qf, **position), tile, jpeg_data))
+        if exported:
+            packed_export.append(exported)
+    return paths
+
+
+# **************************#
+# Content based filtering of the tiles #
+# **************************#
+# Integral image of the edge map of the developed image (see imProc.edge_integral_image), or None when the tiles are
+# not scored
+def tile_scoring_integral(im):
+    if not config_process["tile_scoring"]:
+        return None
+    return imProc.edge_integral_image(im, config_process["tile_edge_threshold"])
+
+
+# Yields (path, tile, position) for the tiles to be compressed, position being the index, the position, the size and the
+# weight of the tile; tiles whose edge density is below the threshold are dropped (or only down-weighted, never to 0)
+# and the score of every tile is added to index_rows (see write_tile_index)
+def selected_tiles(tiles, integral, out_path, imageBaseName, raw_folder, version, index_rows):
+    min_density = config_process["tile_min_edge_density"]
+    for i, row, col, tile in tiles:
+        path = os.path.join(out_path, imageBaseName + "_" + str(i + 1) + ".jpg")
+        weight = 1.
+        if integral is not None:
+            density = imProc.tile_edge_density(integral, row, col, tile.shape[0], tile.shape[1])
+            if min_density is not None and density < min_density:
+                if config_process["tile_filter_mode"] == "drop":
+                    weight = 0.
+                else:
+                    weight = max(config_process["tile_min_weight"], density / min_density)
+            index_rows.append("%s,%s,%s,%d,%d,%d,%d,%d,%.5f,%.4f,%s\n" % (
+                raw_folder, imageBaseName, version, i + 1, row, col, tile.shape[0], tile.shape[1], density, weight,
+                path if weight > 0 else ""))
+        if weight > 0:
+            yield path, tile, dict(tile=i + 1, row=row, col=col, height=tile.shape[0], width=tile.shape[1],
+                                   weight=weight)
+
+
+def write_tile_index(index_rows):
+    # All the rows of an image are appended at once, so that the rows of different workers are not interleaved
+    if index_rows:
+        with open(tile_index_path, "a") as tile_index:
+            tile_index.write("".join(index_rows))
+
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Conversion of one image, reporting the time spent by the worker, and whether the image was converted, to the live
+# metrics
+def convert_and_report(RAWimageName, RAWpath):
+    if bool_live_metrics:
+        record_event(metrics_spool_path, "task_start")
+    converted = False
+    try:
+        converted = From_RAW_to_JPG(RAWimageName, RAWpath)
+    finally:
+        if bool_live_metrics:
+            record_event(metrics_spool_path, "task_end", converted=converted)
+
+
+# **************************#
+# Steps of the conversion #
+# **************************#
+# Call of an external tool (see toolRunner.run) or of a CPU heavy function, yielded by conversion_steps; memory is
+# either None or the pair (stage, number of pixels) used to admit the step within the RAM budget. The result of the
+# step is sent back to conversion_steps: for a tool, False if it timed out (the RAW image is quarantined by
+# conversion_steps, once no other tool can read it).
+def tool_step(stage, cmd, input_path, task_name, raw_path, memory=None):
+    return dict(kind="tool", stage=stage, cmd=cmd, input_path=input_path, task_name=task_name, raw_path=raw_path,
+                memory=memory)
+
+
+def cpu_step(function, *args, memory=None, **kwargs):
+    return dict(kind="cpu", function=function, args=args, kwargs=kwargs, memory=memory)
+
+
+# Blocking execution of a step (in a joblib worker); returns the result of the tool (True if it did not time out) or
+# of the function
+def run_step(step):
+    if step["kind"] == "cpu":
+        return admitted_call(step["function"], step["args"], step["kwargs"], step["memory"])
+    with memory_admission(*step["memory"]) if step["memory"] is not None else nullcontext({}) as usage:
+        success = tool_runner.run(step["stage"], step["cmd"], step["input_path"], step["task_name"],
+                                  step["raw_path"])
+        usage["peak"] = tool_runner.last_peak_rss
+    return success
+
+
+# CPU heavy function run within the RAM budget (in a joblib worker or in a process of the pool of the asyncio
+# orchestration)
+def admitted_call(function, args, kwargs, memory):
+    with memory_admission(*memory) if memory is not None else nullcontext():
+        return function(*args, **kwargs)
+
+
+# **************************#
+# Asyncio orchestration #
+# **************************#
+# Same as From_RAW_to_JPG, from the coordinator: external tools are run as asyncio subprocesses (at most
+# async_max_tools at once, see tool_slots) and CPU heavy functions in the process pool cpu_pool. The code of
+# conversion_steps between two steps (parameter store, stamps, quarantine ...) blocks on files, hence it is run in the
+# threads of step_threads rather than in the event loop.
+async def From_RAW_to_JPG_async(RAWimageName, RAWpath, cpu_pool, tool_slots, step_threads):
+    loop = asyncio.get_event_loop()
+    RAWreadPath = await loop.run_in_executor(step_threads, claim_raw, RAWimageName, RAWpath)
+    steps = conversion_steps(RAWimageName, RAWpath, RAWreadPath)
+    try:
+        step = await loop.run_in_executor(step_threads, next_step, steps, None)
+        while step["kind"] != "end":
+            result = await run_step_async(step, cpu_pool, tool_slots, step_threads)
+            step = await loop.run_in_executor(step_threads, next_step, steps, result)
+    finally:
+        await loop.run_in_executor(step_threads, release_raw, RAWimageName, RAWpath)
+    return step["converted"]
+
+
+# Next step of the conversion or, once it is over, an "end" step holding whether the image has been converted
+# (StopIteration cannot go through an asyncio future)
+def next_step(steps, result):
+    try:
+        return steps.send(result)
+    except StopIteration as stop:
+        return dict(kind="end", converted=bool(stop.value))
+
+
+async def run_step_async(step, cpu_pool, tool_slots, step_threads):
+    loop = asyncio.get_event_loop()
+    if step["kind"] == "cpu":
+        return await loop.run_in_executor(cpu_pool, admitted_call, step["function"], step["args"], step["kwargs"],
+                                          step["memory"])
+    # The admission of a tool within the RAM budget may wait, hence it is carried out in a thread
+    token = None
+    if memory_budget is not None and step["memory"] is not None:
+        token = await loop.run_in_executor(None, memory_budget.acquire, *step["memory"])
+    peak = [0]
+    try:
+        async with tool_slots:
+            return await tool_runner.run_async(step["stage"], step["cmd"], step["input_path"], step["task_name"],
+                                               step["raw_path"], peak)
+    finally:
+        if token is not None:
+            await loop.run_in_executor(step_threads, release_admission, token, step["memory"], peak[0])
+
+
+def release_admission(token, memory, peak):
+    memory_budget.release(token)
+    memory_budget.record(memory[0], memory[1], peak)
+
+
+# Pool of processes of the CPU heavy steps of the asyncio orchestration; all its processes are forked right away, i.e.
+# before the threads of the main process (live metrics, prefetch) are started, as forking a process with running
+# threads may deadlock it (a lock held by a thread at the time of the fork is never released in the child)
+def start_cpu_pool():
+    cpu_pool = ProcessPoolExecutor(max_workers=async_cpu_workers)
+    list(cpu_pool.map(time.sleep, [0] * async_cpu_workers))
+    return cpu_pool
+
+
+# Conversion of all the images of the plan, async_max_images at a time; each "slot" converts images one after the
+# other and is seen as a worker by the live metrics
+async def convert_plan_async(conversion_plan, cpu_pool):
+    loop = asyncio.get_event_loop()
+    images = [(os.path.join(raw_folder_path_parent, raw_path), RAWimagesName[index])
+              for raw_path, RAWimagesName, image_indices in conversion_plan for index in image_indices]
+    images.reverse()
+    tool_slots = asyncio.Semaphore(async_max_tools)
+
+    async def slot(worker):
+        while images:
+            RAWpath, RAWimageName = images.pop()
+            if bool_live_metrics:
+                await loop.run_in_executor(step_threads, record_worker_event, "task_start", worker)
+            converted = False
             try:
-                tifffile.imwrite(entire_path + "/" + raw_image + "_" + str(k + 1) + ".tif", imagette)
-                imgs.append(imagette)
-            except:
-                print("Error somewhere when the image is being save...")
-                pass
-            k += 1
+                converted = await From_RAW_to_JPG_async(RAWimageName, RAWpath, cpu_pool, tool_slots, step_threads)
+            except Exception as error:
+                print("[ERROR] Conversion of " + os.path.join(RAWpath, RAWimageName) + " FAILED: " + repr(error))
+            finally:
+                if bool_live_metrics:
+                    await loop.run_in_executor(step_threads, record_worker_event, "task_end", worker, converted)
+
+    with ThreadPoolExecutor(max_workers=async_max_images) as step_threads:
+        await asyncio.gather(*[slot("async-" + str(i)) for i in range(async_max_images)])
 
-    return entire_path
+
+def record_worker_event(kind, worker, converted=None):
+    if converted is None:
+        record_event(metrics_spool_path, kind, worker=worker)
+    else:
+        record_event(metrics_spool_path, kind, worker=worker, converted=converted)
+
+
+# Admission of a memory hungry stage within the RAM budget (see "memory_budget.py")
+def memory_admission(stage, nb_pixels):
+    if memory_budget is None:
+        return nullcontext({"peak": None})
+    return memory_budget.admitted(stage, nb_pixels)
+
+
+def report_stage(stage, raw_folder, success):
+    if bool_live_metrics:
+        record_event(metrics_spool_path, "stage", stage=stage, base=raw_folder, status="ok" if success else "failed")
+
+
+# **************************#
+# Prefetched RAW images #
+# **************************#
+# Staged copy of the RAW image (see "raw_prefetch.py"), taken by the worker before the conversion, or None if it is not
+# ready (the RAW image is then read from the RAW base); it is released once the image is demosaiced (or skipped)
+def claim_raw(RAWimageName, RAWpath):
+    if not bool_prefetch_raw:
+        return None
+    return claim_staged_raw(prefetch_staging_dir, os.path.join(RAWpath, RAWimageName))
+
+
+def release_raw(RAWimageName, RAWpath):
+    if bool_prefetch_raw:
+        release_staged_raw(prefetch_staging_dir, os.path.join(RAWpath, RAWimageName))
+
+
+def report_prefetch(hit):
+    if bool_live_metrics and bool_prefetch_raw:
+        record_event(metrics_spool_path, "prefetch", status="hit" if hit else "miss")
+
+
+# **************************#
+# Demosaicing decoders #
+# **************************#
+# FIRST STEP: APPLYING DEMOSAICING ! Note that, we used rawtherapee version 5.7 which seems, as opposed to version 5.3,
+# to handle efficiently X3F Sigma foveon trichromatic sensor
+# RAWreadPath is the path from which the RAW image is read (its staged copy, see claim_raw), RAWimagePath being still
+# used to identify the image
+# The RAW image is quarantined if no decoder produced the TIF image and one of them timed out (another decoder may
+# read an image on which rawtherapee hangs).
+def demosaicing(RAWimagePath, TIFimagePath, demProfile, imageBaseName, RAWreadPath=None):
+    demProfilePath = os.path.join(config_path["dem_profile_dir"], demProfile)
+    RAWreadPath = RAWreadPath if RAWreadPath is not None else RAWimagePath
+    # stages of the decoders that timed out
+    timeouts = []
+    # In preview mode, the embedded preview or the fast demosaicing at a reduced resolution is used instead
+    if preview_mode is not None:
+        if preview_mode == "embedded":
+            yield cpu_step(embedded_preview_tiff, RAWreadPath, TIFimagePath)
+        if not os.path.exists(TIFimagePath):
+            yield from rawtherapee_demosaicing(RAWimagePath, TIFimagePath, preview_dem_profile_path, imageBaseName,
+                                               RAWreadPath, timeouts)
+
+    elif os.path.splitext(RAWimagePath)[1].upper() == ".X3F":
+        # However, some X3F images still cannot be processed with rawtherapee; for this reason we try first to apply
+        # rawtherappe; if it fails, we call x3f_extractor executable. When the routing is enabled, the decoder that
+        # worked for the previous images of the same camera model is tried first.
+        print("[WARNING] Sigma Foveon X3F raw file ! Trying RawTherapee")
+        decoders = [("rawtherapee", lambda: rawtherapee_demosaicing(RAWimagePath, TIFimagePath, demProfilePath,
+                                                                    imageBaseName, RAWreadPath, timeouts)),
+                    ("x3f_extract", lambda: x3f_extract_demosaicing(RAWimagePath, TIFimagePath, imageBaseName,
+                                                                    RAWreadPath, timeouts))]
+        if bool_decoder_routing:
+            yield from x3f_router.decode(routing_key(RAWreadPath), decoders)
+        else:
+            for _, decoder in decoders:
+                if (yield from decoder()):
+                    break
+        if not os.path.exists(TIFimagePath):
+            print("[ERROR] neither rawtherapee nor x3f_extract managed to read this file! Are you sure it is not "
+                  "corrupted ?!?")
+
+    # if not X3F raw image files, we call also rawtherapee
+    else:
+        yield from rawtherapee_demosaicing(RAWimagePath, TIFimagePath, demProfilePath, imageBaseName, RAWreadPath,
+                                           timeouts)
+
+    if timeouts and not os.path.exists(TIFimagePath):
+        tool_runner.quarantine(RAWimagePath, "+".join(timeouts), "timeout")
+
+
+# Both functions (yielding the steps of the conversion, run within the RAM budget) return True if the TIF image
+# (resulting for demosaicing of RAW) has been generated; the stage of the tool is appended to timeouts if it timed out.
+def rawtherapee_demosaicing(RAWimagePath, TIFimagePath, demProfilePath, task_name, RAWreadPath, timeouts):
+    # This is a typical use of the rawtherapee-cli command (note that the output are logged by tool_runner)
+    completed = yield tool_step("demosaic_rawtherapee", ["rawtherapee-cli", "-a", "-q", "-t", "-b16", "-o",
+                                                         TIFimagePath, "-p", demProfilePath, "-c", RAWreadPath],
+                                RAWreadPath, task_name, RAWimagePath,
+                                memory=("demosaic", imProc.raw_nb_pixels(RAWimagePath)))
+    if not completed:
+        timeouts.append("demosaic_rawtherapee")
+    return os.path.exists(TIFimagePath)
+
+
+def x3f_extract_demosaicing(RAWimagePath, TIFimagePath, task_name, RAWreadPath, timeouts):
+    # This is a typical use of binary x3f_extract to dump tiff data from X3F file (note that the output are logged by
+    # tool_runner). The output is written in the temporary directory (rather than next to the RAW, on the possibly
+    # slow or read-only RAW disk) so that matching the TIFimagePath variable is a mere rename.
+    completed = yield tool_step("demosaic_x3f", ["./x3f_extract", "-q", "-tiff", "-no-denoise", "-no-sgain", "-o",
+                                                 os.path.dirname(TIFimagePath), RAWreadPath], RAWreadPath, task_name,
+                                RAWimagePath, memory=("demosaic", imProc.raw_nb_pixels(RAWimagePath)))
+    if not completed:
+        timeouts.append("demosaic_x3f")
+    extracted_path = os.path.join(os.path.dirname(TIFimagePath), os.path.basename(RAWreadPath) + ".tif")
+    if os.path.exists(extracted_path):
+        shutil.move(extracted_path, TIFimagePath)
+    return os.path.exists(TIFimagePath)
+
+
+# **************************#
+# Preview mode #
+# **************************#
+# Size (integer, pair or None) at the resolution of the preview mode
+def preview_size(size):
+    if preview_mode is None or size is None:
+        return size
+    if np.isscalar(size):
+        return max(1, int(round(size * preview_scale)))
+    return tuple(preview_size(one_size) for one_size in size)
+
+
+# The "half_size" demosaicing profile is the fast demosaicing one (for Bayer and X-Trans sensors), in which the
+# resizing of rawtherapee is enabled with the scale of the preview
+def write_preview_dem_profile(profile_path):
+    with open(os.path.join(config_path["dem_profile_dir"], "dem_fast.pp3"), "r", newline="") as profile_file:
+        lines = profile_file.read().splitlines(True)
+    section = None
+    for i, line in enumerate(lines):
+        ending = line[len(line.rstrip("\r\n")):]
+        if line.startswith("["):
+            section = line.strip()
+        elif section == "[Resize]" and line.split("=")[0] in ["Enabled", "Scale", "AppliesTo", "DataSpecified"]:
+            value = {"Enabled": "true", "Scale": str(preview_scale), "AppliesTo": "Full image",
+                     "DataSpecified": "0"}[line.split("=")[0]]
+            lines[i] = line.split("=")[0] + "=" + value + ending
+        elif section in ["[RAW Bayer]", "[RAW X-Trans]"] and line.startswith("Method="):
+            lines[i] = "Method=fast" + ending
+    with open(profile_path, "w", newline="") as profile_file:
+        profile_file.write("".join(lines))
+
+
+# Embedded preview of the RAW file written as the demosaiced image would be (16 bits TIFF), the JPEG being decoded (at
+# a reduced scale when possible) to about the resolution of the preview; returns False if there is no readable preview
+def embedded_preview_tiff(RAWimagePath, TIFimagePath):
+    try:
+        preview = embedded_preview(RAWimagePath, scan_size=2 ** 25)
+        if preview is None:
+            return False
+        # The number of pixels of the sensor is roughly estimated from the size of the RAW file
+        scale = min(1., preview_scale * np.sqrt(imProc.raw_nb_pixels(RAWimagePath) / float(preview.size[0] *
+                                                                                          preview.size[1])))
+        size = (max(1, int(preview.size[0] * scale)), max(1, int(preview.size[1] * scale)))
+        preview.draft("RGB", size)
+        preview = preview.convert("RGB")
+        if preview.size[0] > size[0]:
+            preview = preview.resize(size, Image.LANCZOS)
+        imProc.writing_one_image(np.asarray(preview) / 255., TIFimagePath)
+    except (IOError, OSError, SyntaxError, ValueError):
+        print("[WARNING] The embedded preview of " + RAWimagePath + " cannot be read")
+        return False
+    return True
+
+
+# Developed image (8 bits TIFF), loaded only once for all the JPEG compressions; in grayscale only the first channel
+# is kept
+def load_developed_image(TIFimage3Path):
+    im = tifffile.imread(TIFimage3Path)
+    if bool_grayscale and im.ndim == 3:
+        im = im[:, :, 0]
+    return im
+
+
+# Tiles of the multi crop, as views of the developed image (see "tiling.py"); unless config_process["tile_size"] is
+# set, the image is split into a grid of sqrt(nb_images) x sqrt(nb_images) tiles of equal size (the few last rows /
+# columns of pixels are dropped when the image size is not divisible).
+def multi_crop(im, nb_images):
+    if config_process["tile_size"] is not None:
+        tile_size = preview_size(config_process["tile_size"])
+    else:
+        step = int(round(np.sqrt(nb_images)))
+        tile_size = (im.shape[0] // step, im.shape[1] // step)
+    return tiling.iter_tiles(im, tile_size, preview_size(config_process["tile_stride"]),
+                             config_process["tile_edge_policy"])
 
 
 # **************************#
 #  BEGINNING OF THE SCRIPT  #
 # **************************#
 if __name__ == '__main__':
+    # An unknown preview mode would otherwise be run as "half_size" (into the preview root directory)
+    if preview_mode not in PREVIEW_MODES:
+        raise ValueError("Unknown preview_mode {!r} (expected one of {})".format(preview_mode, PREVIEW_MODES))
+    check_fanout_variants()
+    if config_process["tile_filter_mode"] not in TILE_FILTER_MODES:
+        raise ValueError("Unknown tile_filter_mode {!r} (expected one of {})".format(config_process["tile_filter_mode"],
+                                                                                      TILE_FILTER_MODES))
+    register_fanout_dirs()
+
+    # Verification of an existing base against its manifest (nothing is generated)
+    if sys.argv[1:2] == ["verify"]:
+        profile_hashes = None
+        if os.path.exists(dev_store.schema_path):
+            dev_params = dev_store.columns(["name", "profile_md5"])
+            profile_hashes = {name.decode("utf-8"): profile_md5.decode("utf-8")
+                              for name, profile_md5 in zip(dev_params["name"], dev_params["profile_md5"])}
+        counts = verify_manifest(manifest_path, verify_report_path, n_jobs=multiprocessing.cpu_count(),
+                                 profile_hashes=profile_hashes, plan_hashes=current_plan_hashes)
+        sys.exit(0 if counts is not None and counts["ok"] == sum(counts.values()) else 1)
+
     # The beginning of the script, we get the time
     start_time = time.time()
 
+    # The output directories of this run are new versions of those of remove_dir, the workers write into them (hence the
+    # objects that write into those directories are created again); so are the files that list the outputs (profiles,
+    # manifest, tile index), the live ones being kept until the promotion. An incremental rebuild writes into the
+    # current versions, designated by their actual path so that the manifest does not list the same files under two
+    # paths.
+    output_versions = None
+    if bool_versioned_outputs and (bool_incremental or bool_remove_beginning):
+        if bool_incremental:
+            for d in remove_dir:
+                if os.path.islink(config_path[d]):
+                    config_path[d] = current_target(config_path[d])
+            backup_file_path, manifest_path, tile_index_path = [
+                current_target(path) if os.path.islink(path) else path
+                for path in (backup_file_path, manifest_path, tile_index_path)]
+        else:
+            output_versions = versionedOutputs([config_path[d] for d in remove_dir] +
+                                               [backup_file_path, manifest_path, tile_index_path])
+            version_paths = output_versions.start()
+            for d in remove_dir:
+                config_path[d] = version_paths[config_path[d]]
+            backup_file_path, manifest_path, tile_index_path = [
+                version_paths[path] for path in (backup_file_path, manifest_path, tile_index_path)]
+        output_manifest = outputManifest(manifest_path)
+        dev_store = paramStore(config_path["param_store_dir"], DEV_PARAM_SCHEMA)
+        stamp_cache = stageCache(config_path["stamp_dir"])
+        tool_runner.log_dir = config_path["log_dir"]
+        packed_export = packedExport(config_path["export_dir"], store_pixels=packed_export_pixels,
+                                     store_jpeg=packed_export_jpeg)
+
     # First of all, we check out if some specified directories need to be created and do so.
     for d in config_path:
-        # Remove part 264-268
-        if bool_remove_beginning and d in remove_dir and os.path.exists(config_path[d]):
+        # Remove part 264-268 (never for an incremental rebuild, which reuses the outputs of the previous run)
+        if bool_remove_beginning and not bool_incremental and output_versions is None and d in remove_dir and \
+                os.path.exists(config_path[d]):
             shutil.rmtree(config_path[d])
 
         if d is not "raw_dir" and not os.path.exists(config_path[d]):
@@ -434,33 +1301,99 @@ if __name__ == '__main__':
             # List of RAW images into the specified directory
             # RAWimagesName = os.listdir(config_path["raw_dir"])
 
-    if os.path.exists(backup_file_path):
-        os.remove(backup_file_path)
+    dev_store.create()
+    if preview_mode is not None:
+        write_preview_dem_profile(preview_dem_profile_path)
+    # (the files of a versioned run are new, those of the previous run are only replaced by the promotion)
+    for path in (backup_file_path, tile_index_path, manifest_path):
+        if os.path.exists(path) and not bool_incremental and output_versions is None:
+            os.remove(path)
+    if config_process["tile_scoring"] and not os.path.exists(tile_index_path):
+        with open(tile_index_path, "w") as tile_index:
+            tile_index.write("base,image,version,tile,row,col,height,width,edge_density,weight,path\n")
+
+    # The script can be launched using multiprocessing
+    # Default configuration is to use half of the number of cores ... you can set this value to something higher
+    # (Remi used 3/4 of total number of cores)
+    # numCores = int(multiprocessing.cpu_count() / 2)  # 50% of CPUs
+    # numCores = int(multiprocessing.cpu_count() * 2 / 3)  # 66% of CPUs
+    numCores = int(multiprocessing.cpu_count() * 3 / 4)  # 75% of CPUs
+    # With a RAM budget, the memory is no longer the limiting factor, hence all cores can be used
+    if memory_budget is not None:
+        numCores = multiprocessing.cpu_count()
+        memory_budget.reset()
 
-    # For each folder in raw_dir
-    for raw_path in config_path["raw_dir"]:
-        RAWimagesName = sorted(os.listdir(os.path.join(raw_folder_path_parent, raw_path)))
+    # For each folder in raw_dir, we first list the images to be converted so that the total amount of work is known
+    # from the beginning (for the ETA of the live metrics)
+    raw_listing = [(raw_path, os.path.join(raw_folder_path_parent, raw_path),
+                    sorted(os.listdir(os.path.join(raw_folder_path_parent, raw_path))))
+                   for raw_path in config_path["raw_dir"]]
+    # Duplicates are dropped before any image is selected (hence before any call to rawtherapee)
+    if bool_dedup_raw and preview_mode is None:
+        deduplicator = rawDeduplicator(dedup_index_path, dedup_report_path, near_duplicates=dedup_near_duplicates,
+                                       drop_near_duplicates=dedup_drop_near_duplicates,
+                                       max_distance=dedup_max_distance, n_jobs=numCores)
+        raw_listing, _ = deduplicator.deduplicate(raw_listing)
 
+    conversion_plan = []
+    for raw_path, _, RAWimagesName in raw_listing:
         # Random selection of a subset of images (the total number of image picked is specified in config_process
         # --> number_of_output_images)
         # We selected random indices
         image_indices = np.arange(len(RAWimagesName))
         np.random.shuffle(image_indices)
         image_indices = image_indices[0:min(config_process["number_of_output_images"], len(RAWimagesName) * 16)]
+        if preview_mode is not None:
+            image_indices = image_indices[0:preview_nb_images]
         print("Number of images to be created/converted : ",
               min(config_process["number_of_output_images"], len(RAWimagesName) * config_process["jpg_per_raw"]))
+        conversion_plan.append((raw_path, RAWimagesName, image_indices))
+
+    # The packed export is preallocated for all the tiles that may be produced (for an incremental rebuild, the tiles
+    # compressed again are appended to the existing export)
+    if packed_export_version is not None and not (bool_incremental and packed_export.exists()):
+        tile_shape, max_tiles = packed_export_layout()
+        packed_export.create(max_tiles * sum(len(image_indices) for _, _, image_indices in conversion_plan),
+                             tile_shape)
+
+    # (the processes of the asyncio orchestration are started before any thread)
+    if orchestration == "asyncio":
+        cpu_pool = start_cpu_pool()
+
+    if bool_live_metrics:
+        metrics = metricsAggregator(metrics_spool_path, metrics_textfile_path,
+                                    async_max_images if orchestration == "asyncio" else numCores,
+                                    http_port=metrics_http_port)
+        for raw_path, _, image_indices in conversion_plan:
+            metrics.set_planned(raw_path, len(image_indices))
+        metrics.start()
+
+    # The RAW images are read ahead in the order in which they are going to be converted
+    if bool_prefetch_raw:
+        prefetcher = rawPrefetcher(prefetch_staging_dir, prefetch_max_gb * 2 ** 30, window=prefetch_window,
+                                   spool_path=metrics_spool_path if bool_live_metrics else None)
+        prefetcher.start([os.path.join(raw_folder_path_parent, raw_path, RAWimagesName[index])
+                          for raw_path, RAWimagesName, image_indices in conversion_plan for index in image_indices])
+
+    if orchestration == "asyncio":
+        with cpu_pool:
+            asyncio.run(convert_plan_async(conversion_plan, cpu_pool))
+    else:
+        for raw_path, RAWimagesName, image_indices in conversion_plan:
+            Parallel(n_jobs=numCores, verbose=1)(
+                delayed(convert_and_report)(
+                    RAWpath=os.path.join(raw_folder_path_parent, raw_path),
+                    RAWimageName=RAWimagesName[index]
+                ) for index in image_indices)
+
+    if bool_prefetch_raw:
+        prefetcher.stop()
+    if bool_live_metrics:
+        metrics.stop()
 
-        # The script can be launched using multiprocessing
-        # Default configuration is to use half of the number of cores ... you can set this value to something higher
-        # (Remi used 3/4 of total number of cores)
-        # numCores = int(multiprocessing.cpu_count() / 2)  # 50% of CPUs
-        # numCores = int(multiprocessing.cpu_count() * 2 / 3)  # 66% of CPUs
-        numCores = int(multiprocessing.cpu_count() * 3 / 4)  # 75% of CPUs
-        Parallel(n_jobs=numCores, verbose=1)(
-            delayed(From_RAW_to_JPG)(
-                RAWpath=os.path.join(raw_folder_path_parent, raw_path),
-                RAWimageName=RAWimagesName[index]
-            ) for index in image_indices)
+    # The new outputs replace the previous ones only once all images have been converted
+    if output_versions is not None:
+        output_versions.promote()
 
     # At the end of the script we get the time too and make the difference between the start_time and now
     print("\nTime to create the all base: " + str(datetime.timedelta(seconds=round(time.time() - start_time))))
@@ -0,0 +1,117 @@
+import os
+import time
+import struct
+
+import shared_state
+
+# Script used to learn which decoder manages to read a given family of RAW files.
+# Some RAW formats (typically the Sigma Foveon X3F files) can only be read by rawtherapee for some camera models; for
+# the others, one has to fall back on the x3f_extract executable. Instead of paying, for every single image, a full
+# (failed) rawtherapee run, we keep a persistent routing table, keyed by format and camera model, that records:
+#   1) "preferred"      --> the decoder that succeeded on the last image of this family
+#   2) "decoders"       --> for each decoder, the number of successes / failures and its mean running time
+#   3) "since_probe"    --> the number of images routed since the last "probe", i.e. the last time all decoders have
+#                           been tried again in the default order (to detect, e.g., a new rawtherapee version that now
+#                           handles this camera model).
+# The table is stored in a JSON file (see "shared_state.py") so that it is shared between workers and kept from one
+# run to the next.
+
+
+# **************************#
+# Camera model of a Sigma X3F file #
+# **************************#
+def x3f_camera_model(path):
+    # The X3F file ends with the offset of a directory section ("SECd") listing all sections; among those the "PROP"
+    # section contains (UTF-16) pairs name / value of properties, including the camera model "CAMMODEL".
+    # Returns None if the file cannot be parsed (for instance for the most recent Quattro files).
+    try:
+        with open(path, "rb") as raw_file:
+            if raw_file.read(4) != b"FOVb":
+                return None
+            raw_file.seek(-4, os.SEEK_END)
+            raw_file.seek(struct.unpack("<I", raw_file.read(4))[0])
+            if raw_file.read(4) != b"SECd":
+                return None
+            _, nb_entries = struct.unpack("<II", raw_file.read(8))
+            entries = [struct.unpack("<II4s", raw_file.read(12)) for _ in range(nb_entries)]
+            for offset, length, section_type in entries:
+                if section_type != b"PROP":
+                    continue
+                raw_file.seek(offset)
+                if raw_file.read(4) != b"SECp":
+                    return None
+                _, nb_props, char_format, _, nb_chars = struct.unpack("<IIIII", raw_file.read(20))
+                if char_format != 0:
+                    return None
+                props = [struct.unpack("<II", raw_file.read(8)) for _ in range(nb_props)]
+                chars = raw_file.read(2 * nb_chars).decode("utf-16-le", errors="replace")
+                for name_offset, value_offset in props:
+                    name = chars[name_offset:chars.find("\x00", name_offset)]
+                    if name == "CAMMODEL":
+                        return chars[value_offset:chars.find("\x00", value_offset)].strip()
+    except (IOError, OSError, struct.error):
+        return None
+    return None
+
+
+def routing_key(path):
+    # Key used in the routing table: RAW format, and, when it can be read, camera model
+    extension = os.path.splitext(path)[1].upper().lstrip(".")
+    model = None
+    if extension == "X3F":
+        model = x3f_camera_model(path)
+    return extension + ":" + (model if model else "UNKNOWN")
+
+
+class decoderRouter:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # table_path is the JSON file in which the routing table is stored while reprobe_every is the number of images
+    # after which all decoders are tried again in their default order.
+    def __init__(self, table_path, reprobe_every=50):
+        self.table_path = table_path
+        self.reprobe_every = reprobe_every
+
+    # Order in which the decoders should be tried for the given key; decoder_names is the default order.
+    def order(self, key, decoder_names):
+        def choose(table):
+            entry = table.setdefault(key, {"preferred": None, "since_probe": 0, "decoders": {}})
+            if entry["preferred"] not in decoder_names or entry["since_probe"] >= self.reprobe_every:
+                entry["since_probe"] = 0
+                return list(decoder_names)
+            entry["since_probe"] += 1
+            return [entry["preferred"]] + [name for name in decoder_names if name != entry["preferred"]]
+
+        return shared_state.update_json(self.table_path, choose)
+
+    # Storing the outcome of one decoder run
+    def record(self, key, name, success, elapsed):
+        def store(table):
+            entry = table.setdefault(key, {"preferred": None, "since_probe": 0, "decoders": {}})
+            stats = entry["decoders"].setdefault(name, {"success": 0, "failure": 0, "mean_time": 0.})
+            if success:
+                stats["success"] += 1
+                # Running mean of the decoding time (only successful runs are meaningful)
+                stats["mean_time"] += (elapsed - stats["mean_time"]) / stats["success"]
+                entry["preferred"] = name
+            else:
+                stats["failure"] += 1
+                if entry["preferred"] == name:
+                    entry["preferred"] = None
+
+        shared_state.update_json(self.table_path, store)
+
+    # decoders is a list of pairs (name, steps) in the default order; steps() runs the decoder and returns True if it
+    # succeeded. As the decoders are run through the steps of the conversion (see conversion_steps in
+    # "Base_Generator.py"), steps() is a generator and so is this function: it is used with "yield from" and returns
+    # the name of the decoder that succeeded, or None if all of them failed.
+    def decode(self, key, decoders):
+        decoders_dict = dict(decoders)
+        for name in self.order(key, [name for name, _ in decoders]):
+            start_time = time.time()
+            success = yield from decoders_dict[name]()
+            self.record(key, name, success, time.time() - start_time)
+            if success:
+                return name
+        return None
@@ -0,0 +1,155 @@
+import os
+import signal
+import time
+import asyncio
+import subprocess
+
+import shared_state
+from memory_budget import peak_rss
+
+# Script used to run the external tools (rawtherapee-cli, x3f_extract) with a watchdog.
+# A single pathological RAW file can make those tools hang forever, which would block a joblib worker for the rest of
+# the (possibly multi-day) run. Hence every call:
+#   1) is given a timeout that scales with the size of its input file ("timeout_base" seconds plus "timeout_per_mb"
+#      seconds per MB of input, bounded by "timeout_max")
+#   2) is run in its own process group, so that the whole group (the tool and all the children it may have spawned)
+#      is killed when the timeout expires
+#   3) is retried at most "max_retries" times; if all attempts time out, the call fails and the caller may then
+#      "quarantine" the image, i.e. store it in a persistent list (see "shared_state.py") so that it is skipped by all
+#      the subsequent runs. This is left to the caller as another tool may still read the image (e.g. x3f_extract when
+#      rawtherapee hangs on an X3F image).
+# The (very verbose) output of each tool is captured in a log file per image and per stage, in log_dir.
+# Both a blocking version (run, for the joblib workers) and an asyncio version (run_async, for the coordinator of the
+# asyncio orchestration which drives many tools at once) are available.
+
+
+# **************************#
+# Run one command with a timeout #
+# **************************#
+# Returns the return code of the command, or None if it has been killed because of the timeout. While waiting, the
+# peak RSS of the command is polled every second and stored in peak[0] (if given).
+def run_with_timeout(cmd, log_file, timeout, peak=None):
+    process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return process.wait(timeout=max(0, min(1, deadline - time.time())))
+        except subprocess.TimeoutExpired:
+            if peak is not None:
+                peak[0] = max(peak[0], peak_rss(process.pid))
+            if time.time() >= deadline:
+                break
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+    return None
+
+
+# Same as run_with_timeout, without blocking the event loop
+async def run_with_timeout_async(cmd, log_file, timeout, peak=None):
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=log_file, stderr=subprocess.STDOUT,
+                                                   start_new_session=True)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return await asyncio.wait_for(process.wait(), timeout=max(0, min(1, deadline - time.time())))
+        except asyncio.TimeoutError:
+            if peak is not None:
+                peak[0] = max(peak[0], peak_rss(process.pid))
+            if time.time() >= deadline:
+                break
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await process.wait()
+    return None
+
+
+class toolRunner:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    def __init__(self, log_dir, quarantine_path, timeout_base=120, timeout_per_mb=10, timeout_max=1800,
+                 max_retries=1):
+        self.log_dir = log_dir
+        self.quarantine_path = quarantine_path
+        self.timeout_base = timeout_base
+        self.timeout_per_mb = timeout_per_mb
+        self.timeout_max = timeout_max
+        self.max_retries = max_retries
+        # Peak RSS (in bytes) of the last command run (0 if too short to be measured)
+        self.last_peak_rss = 0
+
+    # Timeout (in seconds) allowed to process the given input file
+    def timeout(self, input_path):
+        try:
+            size_mb = os.path.getsize(input_path) / 2 ** 20
+        except OSError:
+            size_mb = 0
+        return min(self.timeout_max, self.timeout_base + self.timeout_per_mb * size_mb)
+
+    def log_path(self, task_name, stage):
+        return os.path.join(self.log_dir, task_name + "_" + stage + ".log")
+
+    # Run the command cmd for the given stage of the given task (image), input_path being the file processed by the
+    # command (used for the timeout) and raw_path the RAW image it comes from; returns False if the command timed out
+    # at every attempt (the image is not quarantined, see quarantine), True otherwise.
+    def run(self, stage, cmd, input_path, task_name, raw_path):
+        timeout = self.timeout(input_path)
+        peak = [0]
+        with open(self.log_path(task_name, stage), "ab") as log_file:
+            for attempt in range(self.max_retries + 1):
+                start_time = self.log_attempt(log_file, stage, cmd, attempt, timeout)
+                return_code = run_with_timeout(cmd, log_file, timeout, peak)
+                self.last_peak_rss = peak[0]
+                if return_code is not None:
+                    return True
+                self.warn_timeout(stage, input_path, attempt, start_time)
+        return False
+
+    # Same as run, for the asyncio orchestration; as several commands run at the same time, the peak RSS of the
+    # command is stored in peak[0] (if given) rather than in last_peak_rss
+    async def run_async(self, stage, cmd, input_path, task_name, raw_path, peak=None):
+        timeout = self.timeout(input_path)
+        peak = [0] if peak is None else peak
+        with open(self.log_path(task_name, stage), "ab") as log_file:
+            for attempt in range(self.max_retries + 1):
+                start_time = self.log_attempt(log_file, stage, cmd, attempt, timeout)
+                return_code = await run_with_timeout_async(cmd, log_file, timeout, peak)
+                if return_code is not None:
+                    return True
+                self.warn_timeout(stage, input_path, attempt, start_time)
+        return False
+
+    @staticmethod
+    def log_attempt(log_file, stage, cmd, attempt, timeout):
+        log_file.write("### {} attempt {} (timeout {:.0f}s): {}\n".format(
+            stage, attempt + 1, timeout, " ".join(cmd)).encode("utf-8"))
+        log_file.flush()
+        return time.time()
+
+    def warn_timeout(self, stage, input_path, attempt, start_time):
+        print("[WARNING] {} timed out after {:.0f}s on {} (attempt {}/{})".format(
+            stage, time.time() - start_time, input_path, attempt + 1, self.max_retries + 1))
+
+    # Logs are only useful for debugging failed images; they are removed once the image is successfully converted
+    def clean_logs(self, task_name, stages):
+        for stage in stages:
+            if os.path.exists(self.log_path(task_name, stage)):
+                os.remove(self.log_path(task_name, stage))
+
+    # **************************#
+    # Quarantine list, persisted across runs #
+    # **************************#
+    def quarantine(self, raw_path, stage, reason):
+        def store(quarantined):
+            quarantined[raw_path] = {"stage": stage, "reason": reason, "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+        print("[ERROR] " + raw_path + " quarantined (" + stage + " " + reason + ")")
+        shared_state.update_json(self.quarantine_path, store)
+
+    def is_quarantined(self, raw_path):
+        return raw_path in shared_state.read_json(self.quarantine_path)
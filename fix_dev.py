@@ -58,10 +58,14 @@ class devFixGenerator:
         self.resize_kernel = {"kernel": lambda: Image.LANCZOS}
         self.resize_weight = {"factor": lambda: 0}
 
+    # Generator from which the parameter key is drawn (see devRandomGenerator.stream)
+    def stream(self, key):
+        return self.r
+
     # Random profile according to the probabilities associated with each development step, as step in the variable
     # process_config from the main script ALASKA_conversion.py, we pick, or not, a random value for each parameter
     # following the distribution defined in the initializer The development process is eventually written into a
-    # rawtherapee compatible pp3 file.
+    # rawtherapee compatible pp3 file (if outputPath is not None, see render_RT_profile).
     def generate_fix_RT_profile(self, imageDevList, outputPath, backupfile, prob_usm_if_denoise):
         radius = 0
         amount = 0
@@ -69,105 +73,141 @@ class devFixGenerator:
         luminance = 0
         detail = 0
         USM_before_DENOISE = 1
+        sharpening = "none"
+        denoise = 0
 
-        # This is the pp3 file in which development parameters will be written for later used in rawtherapee.
-        currentProfile = open(outputPath, 'w+')
-        # Writing of the header of pp3 file.
-        currentProfile.write("[Version]\nAppVersion=5.4\nVersion=331\n\n")
         # Specifies if denoising is applied prior or after sharpening.
         if prob_usm_if_denoise < 0.5:
             # There we start we sharpening  and pick randomly the associated parameters (radius and amount)
             if imageDevList["choice"]["shr"] == 1:
                 # we choice the sharening method: Unsharpening mask or RL deconvolution
                 if imageDevList["choice"]["usm"] == 1:
+                    sharpening = "usm"
                     radius = self.usm["radius"]()
                     amount = self.usm["amount"]()
-                    currentProfile.write(
-                        "[Sharpening]\nEnabled=true\nMethod=usm\nRadius={}"
-                        "\nAmount={}\nThreshold=20;80;2000;1200;\n\n".format(radius, amount))
                 else:
+                    sharpening = "rld"
                     radius = self.rld["radius"]()
                     amount = self.rld["amount"]()
                     iterations = self.rld["iterations"]()
-                    currentProfile.write(
-                        "[Sharpening]\nEnabled=true\nMethod=rld\nDeconvRadius={}"
-                        "\nDeconvAmount={}\nDeconvIterations={}\n\n".format(radius, amount, iterations))
 
                 # and, in needed, specifies the parameters for the denoising
                 if imageDevList["choice"]["denois_if_usm"] == 1:
+                    denoise = 1
                     luminance = self.denois["luminance"]()
                     detail = self.denois["detail"]()
-                    currentProfile.write("[Directional Pyramid Denoising]\nEnabled=true\nEnhance=false\nMedian=false"
-                                         "\nLuma={}\nLdetail={}\n\n".format(luminance, detail))
 
                 # there the steps are applied in the other way round, i.e denoising first ....
         else:
             USM_before_DENOISE = 0
             if imageDevList["choice"]["denois"] == 1:
+                denoise = 1
                 luminance = self.denois["luminance"]()
                 detail = self.denois["detail"]()
-                currentProfile.write("[Directional Pyramid Denoising]\nEnabled=true\nEnhance=false\nMedian=false"
-                                     "\nLuma={}\nLdetail={}\n\n".format(luminance, detail))
                 # ... and then sharpening .
                 if imageDevList["choice"]["usm_if_denois"] == 1:
                     if imageDevList["choice"]["usm"] == 1:
+                        sharpening = "usm"
                         radius = self.usm["radius"]()
                         amount = self.usm["amount"]()
-                        currentProfile.write(
-                            "[Sharpening]\nEnabled=true\nMethod=usm\nRadius={}"
-                            "\nAmount={}\nThreshold=20;80;2000;1200;\n\n".format(radius, amount))
                     else:
+                        sharpening = "rld"
                         radius = self.rld["radius"]()
                         amount = self.rld["amount"]()
                         iterations = self.rld["iterations"]()
-                        currentProfile.write(
-                            "[Sharpening]\nEnabled=true\nMethod=rld\nDeconvRadius={}"
-                            "\nDeconvAmount={}\nDeconvIterations={}\n\n".format(radius, amount, iterations))
-        currentProfile.close()
 
-        # Optional: one can log all development parameters for all images into a single file. If so we write into a
-        # slightly more verbose the development parameters
+        # The parameters picked are kept along with the image development list (for logging purpose and to render the
+        # pp3 file)
+        imageDevList["profile"] = {"usm_before_denoise": USM_before_DENOISE, "sharpening": sharpening,
+                                   "radius": radius, "amount": amount, "iterations": iterations, "denoise": denoise,
+                                   "luminance": luminance, "detail": detail}
+
+        # This is the pp3 file in which development parameters will be written for later used in rawtherapee.
+        if outputPath is not None:
+            with open(outputPath, 'w+') as currentProfile:
+                currentProfile.write(self.render_RT_profile(imageDevList["profile"]))
+
+        # Optional: one can log all development parameters for all images into a single file.
         if backupfile is not None:
-            BackupProfile = open(backupfile, 'a+')
-            if radius == 0 and amount == 0 and iterations == 0:
-                SHR_set = "OFF"
-            elif iterations == 0:
-                SHR_set = "ON"
-                SHR_method = "USM"
-            else:
-                SHR_set = "ON"
-                SHR_method = "RL decon"
-
-            if luminance == 0 and detail == 0:
-                DENOISE_set = "OFF"
-            else:
-                DENOISE_set = "ON"
-
-            RESIZE_factor = imageDevList["subsampling_factor"]
-            if imageDevList["subsampling_type"] == 0:
-                RESIZE_set = "ON_WITH_CROP"
-                RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
-            elif imageDevList["subsampling_type"] == 1:
-                RESIZE_set = "ON_ALONE"
-                RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
-            elif imageDevList["subsampling_type"] == 2:
-                RESIZE_set = "CROP_ONLY"
-                RESIZE_kernel = "NONE"
-            else:
-                RESIZE_set = "OFF"
-
-            # The line written into the log file
-            BackupProfile.write(
-                "%30s | DEM %20s | %d | SHR %s, %3s , %5.2f , %6.2f | DENOISE %3s , %5.2f , %5.2f | "
-                "RESIZE %s , %s , %5.5f | %4d x %4d | %3d \n" % (
-                    imageDevList["name"],
-                    imageDevList["dem"],
-                    USM_before_DENOISE,
-                    SHR_set, SHR_method ,radius, amount,
-                    DENOISE_set, luminance, detail,
-                    RESIZE_set, RESIZE_kernel, RESIZE_factor,
-                    imageDevList["crop_size"][0], imageDevList["crop_size"][1],
-                    imageDevList["qf"])
-            )
+            self.write_backup_line(imageDevList, backupfile)
+
+    # Content of the rawtherapee compatible pp3 file of the parameters picked by generate_fix_RT_profile; it is only
+    # rendered when rawtherapee needs it (the parameters themselves are stored in the parameter store, see
+    # "param_store.py")
+    @staticmethod
+    def render_RT_profile(profile):
+        # Writing of the header of pp3 file.
+        sections = ["[Version]\nAppVersion=5.4\nVersion=331\n\n"]
+        if profile["sharpening"] == "usm":
+            sharpening_section = "[Sharpening]\nEnabled=true\nMethod=usm\nRadius={}" \
+                                 "\nAmount={}\nThreshold=20;80;2000;1200;\n\n".format(profile["radius"],
+                                                                                     profile["amount"])
+        elif profile["sharpening"] == "rld":
+            sharpening_section = "[Sharpening]\nEnabled=true\nMethod=rld\nDeconvRadius={}" \
+                                 "\nDeconvAmount={}\nDeconvIterations={}\n\n".format(profile["radius"],
+                                                                                    profile["amount"],
+                                                                                    profile["iterations"])
+        else:
+            sharpening_section = ""
+        denoise_section = "[Directional Pyramid Denoising]\nEnabled=true\nEnhance=false\nMedian=false" \
+                          "\nLuma={}\nLdetail={}\n\n".format(profile["luminance"], profile["detail"]) \
+            if profile["denoise"] == 1 else ""
+        # Specifies if denoising is applied prior or after sharpening.
+        if profile["usm_before_denoise"] == 1:
+            sections += [sharpening_section, denoise_section]
+        else:
+            sections += [denoise_section, sharpening_section]
+        return "".join(sections)
+
+    # If so we write into a slightly more verbose the development parameters; note that this requires the resizing
+    # factor ( imageDevList["subsampling_factor"] ) which is only known once the resizing has been carried out.
+    def write_backup_line(self, imageDevList, backupfile):
+        radius = imageDevList["profile"]["radius"]
+        amount = imageDevList["profile"]["amount"]
+        iterations = imageDevList["profile"]["iterations"]
+        luminance = imageDevList["profile"]["luminance"]
+        detail = imageDevList["profile"]["detail"]
+        USM_before_DENOISE = imageDevList["profile"]["usm_before_denoise"]
+        BackupProfile = open(backupfile, 'a+')
+        if radius == 0 and amount == 0 and iterations == 0:
+            SHR_set = "OFF"
+            SHR_method = "NONE"
+        elif iterations == 0:
+            SHR_set = "ON"
+            SHR_method = "USM"
+        else:
+            SHR_set = "ON"
+            SHR_method = "RL decon"
 
+        if luminance == 0 and detail == 0:
+            DENOISE_set = "OFF"
+        else:
+            DENOISE_set = "ON"
+
+        RESIZE_factor = imageDevList["subsampling_factor"]
+        if imageDevList["subsampling_type"] == 0:
+            RESIZE_set = "ON_WITH_CROP"
+            RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
+        elif imageDevList["subsampling_type"] == 1:
+            RESIZE_set = "ON_ALONE"
+            RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
+        elif imageDevList["subsampling_type"] == 2:
+            RESIZE_set = "CROP_ONLY"
+            RESIZE_kernel = "NONE"
+        else:
+            RESIZE_set = "OFF"
+
+        # The line written into the log file
+        BackupProfile.write(
+            "%30s | DEM %20s | %d | SHR %s, %3s , %5.2f , %6.2f | DENOISE %3s , %5.2f , %5.2f | "
+            "RESIZE %s , %s , %5.5f | %4d x %4d | %3d \n" % (
+                imageDevList["name"],
+                imageDevList["dem"],
+                USM_before_DENOISE,
+                SHR_set, SHR_method, radius, amount,
+                DENOISE_set, luminance, detail,
+                RESIZE_set, RESIZE_kernel, RESIZE_factor,
+                imageDevList["crop_size"][0], imageDevList["crop_size"][1],
+                imageDevList["qf"])
+        )
         BackupProfile.close()
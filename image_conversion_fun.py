@@ -1,6 +1,7 @@
 from PIL import Image
 import numpy as np
 import os
+import io
 from scipy.ndimage import filters
 from scipy.signal import medfilt
 from scipy.ndimage import filters
@@ -56,6 +57,37 @@ def jpeg_compression(infile, outpath, qf):
         print("Non TIFF image source OR Non JPG image target ... convertion stopped ...")
 
 
+# JPEG compression of an image already loaded in memory (as a numpy array of uint8); the JPEG file is encoded in memory
+# first and its content returned (None on failure), e.g. to be exported as well (see "packed_export.py")
+def jpeg_compression_array(im, outpath, qf):
+    if outpath.endswith(".jpg") or outpath.endswith(".jpeg"):
+        try:
+            jpeg_buffer = io.BytesIO()
+            Image.fromarray(im).save(jpeg_buffer, format="JPEG", quality=qf, subsampling=0)
+            with open(outpath, "wb") as jpeg_file:
+                jpeg_file.write(jpeg_buffer.getvalue())
+            return jpeg_buffer.getvalue()
+        except IOError:
+            print("Cannot convert image to {}".format(outpath))
+    else:
+        print("Non JPG image target ... convertion stopped ...")
+    return None
+
+
+# **************************#
+# Number of pixels of an image, without reading it (used to estimate the memory needed to process it) #
+# **************************#
+def tiff_nb_pixels(infile):
+    with tifffile.TiffFile(infile) as tif:
+        shape = tif.pages[0].shape
+    return shape[0] * shape[1]
+
+
+def raw_nb_pixels(infile):
+    # A RAW file roughly stores 1.5 byte per pixel (12 / 14 bits sensor data, possibly losslessly compressed)
+    return int(os.path.getsize(infile) / 1.5)
+
+
 # **************************#
 # MOST complex function for resizing (can either by crop / resize with resampling or both) #
 # **************************#
@@ -87,10 +119,10 @@ def image_randomize_resizing(infile, outpath, new_width, new_height, subsampling
             # Then we generate a random value Uniformly in the range [ 0 ;  1 ] and scale it to the acceptable range
             # [ MIN ; 1.25 ]
             resize_Factor = resize_FactorMin + resize_weight * (resize_factor_UB - resize_FactorMin)
-            # We impose a resize with keeping aspect for 1024x1024 image
+            # We impose a resize with keeping aspect for resize_size x resize_size image (1024x1024 by default)
             if resize_size is not None:
-                temp_width = 1024
-                temp_height = 1024
+                temp_width = resize_size
+                temp_height = resize_size
             else:  # Then we carry out the resizing to the dimension multiplied by scaling factor
                 temp_width = int(round(im.shape[0] * resize_Factor))
                 temp_height = int(round(im.shape[1] * resize_Factor))
@@ -172,25 +204,12 @@ def resize_keep_aspect(im, new_w, new_h, kernel):
     return res_im
 
 
-# **************************# SMART crop function, that selects the area with most content #
-# **************************# In brief, it is based on a wavelet decomposition (app for approximation while det
-# stand for details) and we compute edges based on approximations ; while details are used to adjust the threshold
-# wrt the image noise Original method from A Foi, M Trimeche, V Katkovnik, K Egiazarian, "Practical
-# Poissonian-Gaussian noise modeling and fitting for single-image raw-data", IEEE Transactions on Image Processing 17
-#  (10), 1737-1754
-def edge_crop(Z, threshold, cropH, cropW, grid):
-    bool_color = False
-
-    # Conversion of image into grayscale
-    try:
-        if Z.shape[2] == 3:
-            X = rgb2gray(Z)
-            bool_color = True
-        elif Z.shape[2] == 1:  # Is Z is already grayscale, let us keep it unchanged
-            X = Z
-    except:  # Is Z is already grayscale, let us keep it unchanged
-        X = Z
-
+# **************************#
+# Edge map used by the smart crop (and by the scoring of tiles) #
+# **************************#
+# X is a grayscale image; returns the boolean map of pixels detected as edges, the threshold being relative to the
+# local noise level
+def edge_map(X, threshold):
     # definition of filters' Kernel
     unif_kernel = (1 / 49) * np.ones([7, 7])
     gradient_kernel = np.matrix(' -1 0 1; -2 0 2 ; -1 0 1')
@@ -223,6 +242,55 @@ def edge_crop(Z, threshold, cropH, cropW, grid):
     edge_detector = np.abs(vert_grad) + np.abs(horz_grad) + np.abs(lam)
 
     X_edge = edge_detector > s * threshold
+    return X_edge
+
+
+# Integral image of the edge map of an image (RGB or grayscale), computed once per image; the number of edges within
+# any rectangle is then obtained with 4 look-ups (see integral_sum)
+def edge_integral_image(im, threshold=1.5):
+    X = im.astype(np.float64)
+    if X.ndim == 3 and X.shape[2] == 3:
+        X = rgb2gray(X)
+    elif X.ndim == 3:
+        X = X[:, :, 0]
+    X_edge = edge_map(X, threshold)
+    integral = np.zeros((X_edge.shape[0] + 1, X_edge.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(X_edge, axis=0), axis=1)
+    return integral
+
+
+def integral_sum(integral, row, col, height, width):
+    # The rectangle is clipped to the image (e.g. for padded tiles)
+    bottom = min(row + height, integral.shape[0] - 1)
+    right = min(col + width, integral.shape[1] - 1)
+    return integral[bottom, right] - integral[row, right] - integral[bottom, col] + integral[row, col]
+
+
+# Edge density of a tile, i.e. the fraction of its pixels that are edges
+def tile_edge_density(integral, row, col, height, width):
+    return integral_sum(integral, row, col, height, width) / float(height * width)
+
+
+# **************************# SMART crop function, that selects the area with most content #
+# **************************# In brief, it is based on a wavelet decomposition (app for approximation while det
+# stand for details) and we compute edges based on approximations ; while details are used to adjust the threshold
+# wrt the image noise Original method from A Foi, M Trimeche, V Katkovnik, K Egiazarian, "Practical
+# Poissonian-Gaussian noise modeling and fitting for single-image raw-data", IEEE Transactions on Image Processing 17
+#  (10), 1737-1754
+def edge_crop(Z, threshold, cropH, cropW, grid):
+    bool_color = False
+
+    # Conversion of image into grayscale
+    try:
+        if Z.shape[2] == 3:
+            X = rgb2gray(Z)
+            bool_color = True
+        elif Z.shape[2] == 1:  # Is Z is already grayscale, let us keep it unchanged
+            X = Z
+    except:  # Is Z is already grayscale, let us keep it unchanged
+        X = Z
+
+    X_edge = edge_map(X, threshold)
 
     # Once edge detection has been carried out; select the area with highest number of edges
     candidates = np.array(
@@ -0,0 +1,127 @@
+from hashlib import md5
+
+import numpy as np
+
+# Script used to draw random values from a "keyed", counter-based, generator: instead of taking the next values of a
+# sequential stream (np.random.RandomState), whose state depends on all the previous draws, each value is a hash of the
+# seed of the image, of the name ("key") of the parameter and of a counter (for the parameters that need several
+# uniform values). Hence:
+#   1) a value only depends on (seed, key): it does not change when another parameter is drawn, or not, before it
+#      (e.g. when a probability of config_process is changed) and the parameters can be drawn in any order, or lazily
+#   2) the parameters of many images can be drawn at once, the seed being an array of seeds, e.g. the USM amount of
+#      all images: keyedRandomState(seeds).stream("usm_amount").choice(usm_amount_values, p=usm_amount_prob).
+# The hash is the finalizer of SplitMix64, the uniform values are made of its 53 most significant bits and the other
+# distributions are derived from them: inverse of the cumulative distribution for choice (and binomial), Box-Muller
+# transform for normal and Marsaglia-Tsang method for gamma.
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def splitmix64(x):
+    # (the multiplications are modulo 2 ** 64 on purpose)
+    with np.errstate(over="ignore"):
+        z = x + GOLDEN_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def key_hash(key):
+    return np.uint64(int.from_bytes(md5(key.encode("utf-8")).digest()[:8], "big"))
+
+
+class keyedRandomState:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # seed is a (non negative) integer or an array of integers (one per image)
+    def __init__(self, seed):
+        self.shape = np.shape(seed)
+        self.seed = splitmix64(np.atleast_1d(np.asarray(seed, dtype=np.uint64)))
+
+    # Draws of the parameter key
+    def stream(self, key):
+        return keyedStream(self, key)
+
+
+class keyedStream:
+    def __init__(self, state, key):
+        self.state = state
+        self.key = key
+        self.base = splitmix64(state.seed ^ key_hash(key))
+
+    # **************************#
+    # Uniform values #
+    # **************************#
+    # Uniform values in [0, 1) of the counters (an array of integers), for every seed: array of shape
+    # (number of seeds, number of counters)
+    def uniforms(self, counters):
+        counters = np.asarray(counters, dtype=np.uint64)
+        bits = splitmix64(self.base[:, None] + counters[None, :]) >> np.uint64(11)
+        return bits.astype(np.float64) * 2. ** -53
+
+    # Values of shape (number of seeds, size) reshaped as the seed, followed by size (if given)
+    def reshape(self, values, size):
+        values = values.reshape(self.state.shape + (() if size is None else (size,)))
+        return values[()] if values.ndim == 0 else values
+
+    # **************************#
+    # Distributions (as in np.random.RandomState) #
+    # **************************#
+    def uniform(self, low=0., high=1., size=None):
+        u = self.uniforms(np.arange(1 if size is None else size))
+        return self.reshape(low + u * (high - low), size)
+
+    def randint(self, low, high=None, size=None):
+        if high is None:
+            low, high = 0, low
+        u = self.uniforms(np.arange(1 if size is None else size))
+        return self.reshape(low + np.floor(u * (high - low)).astype(np.int64), size)
+
+    def choice(self, a, size=None, p=None):
+        values = np.arange(a) if np.isscalar(a) else np.asarray(a)
+        if p is None:
+            cdf = np.arange(1, len(values) + 1) / float(len(values))
+        else:
+            cdf = np.cumsum(p) / np.sum(p)
+        u = self.uniforms(np.arange(1 if size is None else size))
+        indices = np.minimum(np.searchsorted(cdf, u, side="right"), len(values) - 1)
+        return self.reshape(values[indices], size)
+
+    def binomial(self, n, p, size=None):
+        u = self.uniforms(np.arange(n * (1 if size is None else size))).reshape(-1, 1 if size is None else size, n)
+        return self.reshape(np.sum(u < p, axis=2), size)
+
+    def normal(self, loc=0., scale=1., size=None):
+        return self.reshape(loc + scale * self.standard_normal(0, 1 if size is None else size), size)
+
+    # Box-Muller transform of the counters 2 * (first + i) and 2 * (first + i) + 1, i < size
+    def standard_normal(self, first, size):
+        counters = 2 * np.arange(first, first + size)
+        u1, u2 = self.uniforms(counters), self.uniforms(counters + 1)
+        return np.sqrt(-2. * np.log1p(-u1)) * np.cos(2. * np.pi * u2)
+
+    def gamma(self, shape, scale=1., size=None):
+        n = 1 if size is None else size
+        if shape < 1:
+            # Gamma(shape) = Gamma(shape + 1) * U ** (1 / shape), U being drawn on its own stream
+            boost = self.state.stream(self.key + "/gamma_boost").uniforms(np.arange(n)) ** (1. / shape)
+            return self.reshape(scale * self.standard_gamma(shape + 1., n) * boost, size)
+        return self.reshape(scale * self.standard_gamma(shape, n), size)
+
+    # Marsaglia-Tsang method (shape >= 1): the attempt k of every value uses its own counters, hence the number of
+    # rejections does not change the other values
+    def standard_gamma(self, shape, n):
+        d = shape - 1. / 3.
+        c = 1. / np.sqrt(9. * d)
+        values = np.full((len(self.base), n), np.nan)
+        attempt = 0
+        while np.isnan(values).any():
+            x = self.standard_normal(attempt * n, n)
+            u = self.state.stream(self.key + "/gamma_accept").uniforms(attempt * n + np.arange(n))
+            v = (1. + c * x) ** 3
+            with np.errstate(invalid="ignore"):
+                accepted = (v > 0) & (np.log(u) < 0.5 * x ** 2 + d - d * v + d * np.log(v))
+            values = np.where(np.isnan(values) & accepted, d * v, values)
+            attempt += 1
+        return values
@@ -0,0 +1,166 @@
+import os
+import csv
+import json
+import time
+from hashlib import md5
+
+from joblib import Parallel, delayed
+
+# Script used to check that an existing base is complete and up to date without re-walking the output directories.
+# During the generation, each worker appends, for every output file it writes (JPEG images, tiles, TIFF images), one
+# JSON line to the "manifest": path, size and content hash of the file, stage that produced it along with the hash of
+# its plan (inputs and parameters, see "stage_cache.py"), the source RAW image with its identity at that time and the
+# development profile (name of the image in the parameter store, see "param_store.py") with its hash. The last line of
+# a path supersedes the previous ones (incremental rebuild).
+# The verification (see verify_manifest) reads the manifest and checks, in parallel, chunks of files with large
+# sequential reads; each output is reported as:
+#   1) "missing"    --> the file does not exist anymore
+#   2) "corrupt"    --> its size or its content hash differs from the manifest
+#   3) "stale"      --> the file is intact but its source RAW image or its development profile changed since it was
+#                       produced, or its stage would now be planned differently (e.g. another jpeg_qf or tile setting
+#                       in the configuration).
+
+READ_SIZE = 2 ** 23
+CHUNK_BYTES = 2 ** 28
+
+
+def content_hash(path):
+    digest = md5()
+    with open(path, "rb") as output_file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(output_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for block in iter(lambda: output_file.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_identity(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+class outputManifest:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+
+    # **************************#
+    # Recording, in the workers #
+    # **************************#
+    # outputs is a list of (stage, plan hash, list of paths) for the outputs of an image produced from the RAW image
+    # raw_path with the development profile profile_name, whose hash is profile_md5
+    def record(self, outputs, raw_path, profile_name, profile_md5):
+        source = {"raw": raw_path, "raw_identity": source_identity(raw_path), "profile": profile_name,
+                  "profile_md5": profile_md5}
+        lines = []
+        for stage, plan_hash, paths in outputs:
+            for path in paths:
+                if os.path.exists(path):
+                    entry = dict(source, path=path, size=os.path.getsize(path), md5=content_hash(path), stage=stage,
+                                 plan_hash=plan_hash, date=time.strftime("%Y-%m-%d %H:%M:%S"))
+                    lines.append(json.dumps(entry, sort_keys=True) + "\n")
+        # All the lines of an image are appended at once, so that the lines of different workers are not interleaved
+        with open(self.manifest_path, "a") as manifest_file:
+            manifest_file.write("".join(lines))
+
+    # Last entry of every path
+    def entries(self):
+        entries = dict()
+        with open(self.manifest_path, "r") as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # line being written by a worker
+                    continue
+                entries[entry["path"]] = entry
+        return entries
+
+
+# **************************#
+# Verification #
+# **************************#
+# Status of every entry of a chunk, as a list of (path, status, detail); the identities of the RAW images are computed
+# once per chunk
+def verify_chunk(entries):
+    raw_identities = dict()
+    results = []
+    for entry in entries:
+        path = entry["path"]
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            results.append((path, "missing", ""))
+            continue
+        if size != entry["size"]:
+            results.append((path, "corrupt", "size {} instead of {}".format(size, entry["size"])))
+            continue
+        if content_hash(path) != entry["md5"]:
+            results.append((path, "corrupt", "content hash differs"))
+            continue
+        if entry["raw"] not in raw_identities:
+            raw_identities[entry["raw"]] = source_identity(entry["raw"])
+        if raw_identities[entry["raw"]] != entry["raw_identity"]:
+            results.append((path, "stale", "source RAW changed: " + entry["raw"]))
+        else:
+            results.append((path, "ok", ""))
+    return results
+
+
+# Splits the entries, sorted by path (i.e. by directory), into chunks of about CHUNK_BYTES bytes so that each task of a
+# worker reads many small files in a row
+def chunks_of_entries(entries):
+    chunk, chunk_bytes = [], 0
+    for path in sorted(entries):
+        chunk.append(entries[path])
+        chunk_bytes += entries[path]["size"]
+        if chunk_bytes >= CHUNK_BYTES or len(chunk) >= 10000:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        yield chunk
+
+
+# Checks all the outputs of the manifest and writes the problems found in report_path (CSV); returns the number of
+# outputs per status. profile_hashes is the current hash of the development profile of each image (if given, the
+# outputs whose profile changed, or was removed, are stale). plan_hashes(profile, raw) returns the current hash of every
+# stage of an image, or None if it cannot be computed (if given, the outputs whose plan changed are stale); it is called
+# once per image, in parallel.
+def verify_manifest(manifest_path, report_path, n_jobs=1, profile_hashes=None, plan_hashes=None):
+    if not os.path.exists(manifest_path):
+        print("[ERROR] No manifest found at " + manifest_path)
+        return None
+    start_time = time.time()
+    entries = outputManifest(manifest_path).entries()
+    print("Verifying " + str(len(entries)) + " outputs of " + manifest_path)
+    results = Parallel(n_jobs=n_jobs)(delayed(verify_chunk)(chunk) for chunk in chunks_of_entries(entries))
+    current_plans = dict()
+    if plan_hashes is not None:
+        images = sorted({(entries[path]["profile"], entries[path]["raw"])
+                         for chunk_results in results for path, status, _ in chunk_results if status == "ok"})
+        current_plans = dict(zip(images, Parallel(n_jobs=n_jobs)(delayed(plan_hashes)(*image) for image in images)))
+
+    counts = {"ok": 0, "missing": 0, "corrupt": 0, "stale": 0}
+    with open(report_path, "w") as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(["path", "status", "detail"])
+        for chunk_results in results:
+            for path, status, detail in chunk_results:
+                profile = entries[path]["profile"]
+                if status == "ok" and profile_hashes is not None and \
+                        profile_hashes.get(profile) != entries[path]["profile_md5"]:
+                    status, detail = "stale", "development profile changed: " + profile
+                current_plan = current_plans.get((profile, entries[path]["raw"]))
+                if status == "ok" and current_plan is not None and \
+                        current_plan.get(entries[path]["stage"]) != entries[path]["plan_hash"]:
+                    status, detail = "stale", "plan changed: " + entries[path]["stage"]
+                counts[status] += 1
+                if status != "ok":
+                    writer.writerow([path, status, detail])
+    print("Verification done in {:.0f}s: {ok} ok, {missing} missing, {corrupt} corrupt, {stale} stale (see {})".format(
+        time.time() - start_time, report_path, **counts))
+    return counts
@@ -0,0 +1,146 @@
+import os
+import time
+import itertools
+from contextlib import contextmanager
+
+import shared_state
+
+# Script used to run the memory hungry stages of the conversion within a RAM budget.
+# The peak memory of the conversion of an image varies a lot with the sensor size (e.g. the float64 RGB copy of a
+# RAISE or Dresden image, plus the intermediates of the smart crop "edge_crop"). Instead of limiting the number of
+# workers so that the worst case fits in RAM, each worker asks, before such a stage, to be "admitted":
+#   1) the peak memory of the stage is estimated from the number of pixels of the image, with a number of bytes per
+#      pixel learned from the previous images (stored, per stage, in a JSON file kept from one run to the next)
+#   2) the worker waits until the sum of the estimates of the stages running in all workers (the "ledger", see
+#      "shared_state.py") plus its own estimate fits in the budget; a stage is always admitted when nothing else runs
+#   3) once the stage is over, its actual peak RSS is measured and used to refine the estimate.
+# Note that the budget covers the memory used by the stages on top of the (fixed) footprint of each worker.
+
+# Default number of bytes per pixel, used until the first measurement: rawtherapee working buffers for demosaicing,
+# float64 image plus edge_crop intermediates for resizing
+DEFAULT_BYTES_PER_PIXEL = {"demosaic": 40., "resize": 100.}
+
+# Numbering of the reservations of a process (the coordinator of the asyncio orchestration holds several at once)
+reservation_counter = itertools.count()
+
+
+# **************************#
+# Peak RSS of a process (in bytes), from /proc #
+# **************************#
+def read_status_value(pid, field):
+    try:
+        with open("/proc/{}/status".format(pid), "r") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def peak_rss(pid="self"):
+    return read_status_value(pid, "VmHWM")
+
+
+def current_rss(pid="self"):
+    return read_status_value(pid, "VmRSS")
+
+
+def reset_peak_rss():
+    # Writing "5" in clear_refs resets the peak RSS (VmHWM) to the current RSS (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class memoryBudget:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # budget_bytes is the RAM available for the stages of all workers, ledger_path the JSON file of the current
+    # reservations and estimates_path the JSON file of the learned number of bytes per pixel of each stage.
+    def __init__(self, budget_bytes, ledger_path, estimates_path, margin=1.25, poll_interval=0.5):
+        self.budget_bytes = budget_bytes
+        self.ledger_path = ledger_path
+        self.estimates_path = estimates_path
+        self.margin = margin
+        self.poll_interval = poll_interval
+
+    # Reservations of a previous run are meaningless
+    def reset(self):
+        shared_state.update_json(self.ledger_path, lambda ledger: ledger.clear())
+
+    def estimate(self, stage, nb_pixels):
+        estimates = shared_state.read_json(self.estimates_path)
+        if stage in estimates:
+            return self.margin * estimates[stage]["bytes_per_pixel"] * nb_pixels
+        return DEFAULT_BYTES_PER_PIXEL.get(stage, 50.) * nb_pixels
+
+    # **************************#
+    # Admission of a stage #
+    # **************************#
+    def acquire(self, stage, nb_pixels):
+        needed = self.estimate(stage, nb_pixels)
+        token = "{}:{}:{}".format(os.getpid(), stage, next(reservation_counter))
+
+        def try_reserve(ledger):
+            # reservations of dead workers (killed, e.g., by the OOM killer) are dropped
+            for other_token in [t for t in ledger if not pid_alive(ledger[t]["pid"])]:
+                del ledger[other_token]
+            if not ledger or sum(r["bytes"] for r in ledger.values()) + needed <= self.budget_bytes:
+                ledger[token] = {"pid": os.getpid(), "stage": stage, "bytes": needed}
+                return True
+            return False
+
+        start_time = time.time()
+        while not shared_state.update_json(self.ledger_path, try_reserve):
+            time.sleep(self.poll_interval)
+        if time.time() - start_time > 1:
+            print("[WARNING] {} waited {:.0f}s for {:.0f} MB of RAM".format(stage, time.time() - start_time,
+                                                                            needed / 2 ** 20))
+        return token
+
+    def release(self, token):
+        shared_state.update_json(self.ledger_path, lambda ledger: ledger.pop(token, None))
+
+    # Refines the number of bytes per pixel of the stage (running mean over the last images, roughly)
+    def record(self, stage, nb_pixels, peak_bytes):
+        if nb_pixels <= 0 or peak_bytes <= 0:
+            return
+
+        def store(estimates):
+            measured = float(peak_bytes) / nb_pixels
+            entry = estimates.setdefault(stage, {"bytes_per_pixel": measured, "samples": 0, "max_peak": 0})
+            entry["bytes_per_pixel"] = 0.8 * entry["bytes_per_pixel"] + 0.2 * measured
+            entry["samples"] += 1
+            entry["max_peak"] = max(entry["max_peak"], peak_bytes)
+
+        shared_state.update_json(self.estimates_path, store)
+
+    # Context in which a stage runs once admitted; the caller can set usage["peak"] (e.g. for an external tool),
+    # otherwise the peak RSS of the worker during the stage is measured.
+    @contextmanager
+    def admitted(self, stage, nb_pixels):
+        token = self.acquire(stage, nb_pixels)
+        usage = {"peak": None}
+        baseline = current_rss()
+        reset_peak_rss()
+        try:
+            yield usage
+        finally:
+            self.release(token)
+            if usage["peak"] is None:
+                usage["peak"] = peak_rss() - baseline
+            self.record(stage, nb_pixels, usage["peak"])
@@ -0,0 +1,101 @@
+import os
+import glob
+import time
+import shutil
+import subprocess
+
+# Script used to replace the output directories of a previous run without deleting them first (removing a tree of
+# millions of files takes a long time, during which no RAW image would be processed).
+# Each run writes into fresh "versioned" directories, e.g. "JPEG_Bases/Real_Base_3_TIFF_1024x1024.v20240101_120000",
+# and the usual path of each directory is a symbolic link to the last complete version; the files that describe the
+# outputs (e.g. the manifest) are versioned the same way, so that they are promoted along with the directories:
+#   1) when the run starts, the versions left by an interrupted run (never promoted) are removed, the current version
+#      (the one the link points to) is kept and still readable during the whole run
+#   2) when the run is over, each link is atomically replaced by a link to the new version ("promotion"), hence a
+#      reader sees either the old or the new outputs, never a mix of both
+#   3) the old versions are first renamed (instantaneous) and then removed by a background process with the lowest CPU
+#      and IO priorities (nice / ionice), which goes on after the end of the script.
+# Note that the directories of a run which is interrupted are never promoted.
+
+
+# **************************#
+# Low priority removal of directories #
+# **************************#
+# The directories are renamed to "<path>.trash<suffix>" right away, so that the next run never reuses them, and removed
+# by a detached "rm" process
+def remove_in_background(paths, suffix=""):
+    trash_paths = []
+    for path in paths:
+        trash_path = path if ".trash" in os.path.basename(path) else path + ".trash" + suffix
+        try:
+            os.rename(path, trash_path)
+        except OSError:
+            continue
+        trash_paths.append(trash_path)
+    if not trash_paths:
+        return None
+    cmd = ["rm", "-rf", "--"] + trash_paths
+    if shutil.which("ionice") is not None:
+        cmd = ["ionice", "-c", "3"] + cmd
+    if shutil.which("nice") is not None:
+        cmd = ["nice", "-n", "19"] + cmd
+    print("Removing " + str(len(trash_paths)) + " old outputs in the background")
+    return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+# Directory (or file) that path (a link to a version, or a plain directory of an older run) currently designates
+def current_target(path):
+    if os.path.islink(path):
+        return os.path.join(os.path.dirname(path), os.readlink(path))
+    return path if os.path.exists(path) else None
+
+
+class versionedOutputs:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # paths are the usual paths of the output directories and files (which become links), version the name of the
+    # version of this run (by default, the date and time it started)
+    def __init__(self, paths, version=None):
+        self.version = version if version is not None else time.strftime("%Y%m%d_%H%M%S")
+        self.targets = {path: path + ".v" + self.version for path in paths}
+
+    # **************************#
+    # Beginning of the run #
+    # **************************#
+    # Removes (in the background) the versions that are neither current nor the one of this run, along with the trash
+    # of the previous runs whose removal was interrupted
+    def start(self):
+        stale = []
+        for path, target in self.targets.items():
+            current = current_target(path)
+            for other in glob.glob(glob.escape(path) + ".v*") + glob.glob(glob.escape(path) + ".trash*"):
+                if os.path.exists(other) and not os.path.islink(other) and other != target and \
+                        (current is None or not os.path.samefile(other, current)):
+                    stale.append(other)
+        remove_in_background(stale, "_" + self.version)
+        return self.targets
+
+    # **************************#
+    # End of the run: promotion #
+    # **************************#
+    # Each link is replaced (os.replace is atomic) by a link to the new version; the previous versions are removed in
+    # the background. A directory (or file) of this run which has not been created (e.g. unused) is not promoted.
+    def promote(self):
+        old = []
+        for path, target in self.targets.items():
+            if not os.path.exists(target):
+                continue
+            current = current_target(path)
+            if current is not None and not os.path.islink(path):
+                # Plain directory (or file) of an older run: it has to be moved away before the link can take its place
+                os.rename(path, path + ".trash_" + self.version)
+                current = path + ".trash_" + self.version
+            link_tmp = path + ".link_" + self.version
+            os.symlink(os.path.basename(target), link_tmp)
+            os.replace(link_tmp, path)
+            if current is not None and os.path.exists(current):
+                old.append(current)
+        print("[SUCCESS] Outputs of version " + self.version + " promoted")
+        return remove_in_background(old, "_" + self.version)
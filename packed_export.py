@@ -0,0 +1,145 @@
+import io
+import os
+import csv
+
+import numpy as np
+from PIL import Image
+
+import shared_state
+
+# Script used to export the tiles of a base into a few large files that a training data loader can read by batches,
+# without opening (and decoding) millions of small JPEG files:
+#   1) "tiles.npy"          --> the pixels of all tiles, decoded from their JPEG file (i.e. as seen by a steganalyzer),
+#                               as a single (memory-mappable) numpy array of shape (capacity, tile height, tile width
+#                               [, 3]); the file is preallocated (as a sparse file) when the generation starts and each
+#                               tile is written in its own "slot"
+#   2) "tiles_jpeg.bin"     --> the JPEG files themselves, concatenated (each tile is given by an offset and a size)
+#   3) "tiles.csv"          --> the metadata of each tile: slot, source RAW and base, position of the tile, QF and
+#                               development parameters.
+# The export is streamed: the workers append the tiles of each image, by batches, as soon as they are compressed (see
+# compress_tiles in "Base_Generator.py"). Slots and byte ranges are reserved under a lock (see "shared_state.py"), hence
+# the slots in use are 0 ... "next_slot" - 1, in the order of completion (not in the order of the images). Note that a
+# tile whose shape differs from the one of the array (e.g. a smaller tile of an image with the "drop" edge policy) has
+# no slot (-1) but is still in the JPEG blob.
+# The export is append-only: the tiles re-encoded by an incremental rebuild are appended to new slots, and the rows of
+# their previous version stay in "tiles.csv". The last row of a tile (base, image, version, tile) supersedes the
+# previous ones: open_packed_export only returns the last rows, the slots and byte ranges of the others are unused.
+
+METADATA_COLUMNS = ["slot", "jpeg_offset", "jpeg_size", "base", "image", "raw", "version", "tile", "row", "col",
+                    "height", "width", "weight", "qf", "dem", "subsampling_type", "resize_kernel",
+                    "subsampling_factor", "crop_size", "usm_before_denoise", "sharpening", "radius", "amount",
+                    "iterations", "denoise", "luminance", "detail"]
+
+
+class packedExport:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # export_dir is the directory of the export; the pixels and / or the JPEG files are stored according to
+    # store_pixels and store_jpeg.
+    def __init__(self, export_dir, store_pixels=True, store_jpeg=True):
+        self.pixels_path = os.path.join(export_dir, "tiles.npy")
+        self.jpeg_path = os.path.join(export_dir, "tiles_jpeg.bin")
+        self.metadata_path = os.path.join(export_dir, "tiles.csv")
+        self.state_path = os.path.join(export_dir, "export_state.json")
+        self.store_pixels = store_pixels
+        self.store_jpeg = store_jpeg
+        # The array is mapped (once) by each worker process
+        self.pixels = None
+
+    # **************************#
+    # Creation, in the main process #
+    # **************************#
+    # capacity is the maximal number of tiles, tile_shape the shape of a tile, (height, width) or (height, width, 3);
+    # with tile_shape None (tiles of varying size) only the JPEG files are exported
+    def create(self, capacity, tile_shape):
+        if tile_shape is None and self.store_pixels:
+            print("[WARNING] The tiles of the export have no fixed size, their pixels are not exported")
+        store_pixels = self.store_pixels and tile_shape is not None
+        if store_pixels:
+            # open_memmap only writes the header and the very last byte: the file is sparse until tiles are written
+            np.lib.format.open_memmap(self.pixels_path, mode="w+", dtype=np.uint8,
+                                      shape=(capacity,) + tuple(tile_shape)).flush()
+        if self.store_jpeg:
+            open(self.jpeg_path, "wb").close()
+        with open(self.metadata_path, "w") as metadata_file:
+            metadata_file.write(",".join(METADATA_COLUMNS) + "\n")
+        shared_state.write_json(self.state_path, {"capacity": capacity if store_pixels else 0, "next_slot": 0,
+                                                  "jpeg_size": 0, "store_pixels": store_pixels})
+
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    # **************************#
+    # Streaming of a batch of tiles, in a worker #
+    # **************************#
+    # Returns the first slot and the offset in the JPEG blob reserved for nb_slots tiles and nb_bytes of JPEG files
+    def reserve(self, nb_slots, nb_bytes):
+        def allocate(state):
+            first_slot = state["next_slot"] if state["next_slot"] + nb_slots <= state["capacity"] else -1
+            if first_slot >= 0:
+                state["next_slot"] += nb_slots
+            offset = state["jpeg_size"]
+            state["jpeg_size"] += nb_bytes
+            return first_slot, offset
+
+        return shared_state.update_json(self.state_path, allocate)
+
+    # tiles is a list of (metadata, tile, JPEG file content) where metadata is a dictionary of (some of) the
+    # METADATA_COLUMNS and tile the (uncompressed) tile, only used for its shape
+    def append(self, tiles):
+        store_pixels = shared_state.read_json(self.state_path).get("store_pixels", False)
+        if store_pixels and self.pixels is None:
+            self.pixels = np.load(self.pixels_path, mmap_mode="r+")
+        packed = [tile.shape == self.pixels.shape[1:] if store_pixels else False for _, tile, _ in tiles]
+        nb_bytes = sum(len(data) for _, _, data in tiles) if self.store_jpeg else 0
+        slot, offset = self.reserve(sum(packed), nb_bytes)
+        if store_pixels and slot < 0 and any(packed):
+            print("[WARNING] The packed export is full, the pixels of {} tiles are not exported".format(sum(packed)))
+
+        rows = []
+        jpeg_file = open(self.jpeg_path, "r+b") if self.store_jpeg else None
+        try:
+            for (metadata, _, data), is_packed in zip(tiles, packed):
+                metadata = dict(metadata, slot=-1, jpeg_offset=-1, jpeg_size=0)
+                if is_packed and slot >= 0:
+                    self.pixels[slot] = np.asarray(Image.open(io.BytesIO(data)))
+                    metadata["slot"] = slot
+                    slot += 1
+                if jpeg_file is not None:
+                    os.pwrite(jpeg_file.fileno(), data, offset)
+                    metadata["jpeg_offset"], metadata["jpeg_size"] = offset, len(data)
+                    offset += len(data)
+                rows.append(metadata)
+        finally:
+            if jpeg_file is not None:
+                jpeg_file.close()
+
+        # All the rows of the batch are rendered first and appended with a single write, so that the rows of different
+        # workers are not interleaved (whatever the size of the rows)
+        rendered = io.StringIO()
+        csv.DictWriter(rendered, METADATA_COLUMNS, extrasaction="ignore").writerows(rows)
+        with open(self.metadata_path, "a", newline="") as metadata_file:
+            metadata_file.write(rendered.getvalue())
+
+
+# **************************#
+# Reading of an export (e.g. by a training data loader) #
+# **************************#
+# Returns the array of the pixels of the tiles (memory-mapped, only the slots in use, or None), the JPEG blob (memory-
+# mapped, or None) and the metadata (list of dictionaries, one per tile, with strings as values); the rows superseded by
+# an incremental rebuild are left out of the metadata
+def open_packed_export(export_dir):
+    export = packedExport(export_dir)
+    state = shared_state.read_json(export.state_path)
+    pixels = None
+    if state.get("store_pixels", False):
+        pixels = np.load(export.pixels_path, mmap_mode="r")[:state["next_slot"]]
+    jpeg_blob = None
+    if os.path.exists(export.jpeg_path) and os.path.getsize(export.jpeg_path) > 0:
+        jpeg_blob = np.memmap(export.jpeg_path, dtype=np.uint8, mode="r")
+    last_rows = dict()
+    with open(export.metadata_path, "r", newline="") as metadata_file:
+        for row in csv.DictReader(metadata_file):
+            last_rows[(row["base"], row["image"], row["version"], row["tile"])] = row
+    return pixels, jpeg_blob, list(last_rows.values())
@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+
+import shared_state
+
+# Script used to store the development parameters of all images in a single, queryable, place (instead of one pp3 file
+# per image plus a line of text per image in the backup file, to be parsed with regular expressions).
+# The store is "columnar": each parameter (column) is stored in its own binary file of fixed-size values (see the
+# numpy dtype of each column in the schema), and the list of the columns is written in "schema.json". Hence:
+#   1) a row (an image) is appended, or updated in place, by writing one value at a known offset in each file; this is
+#      done under a lock (see "shared_state.py") so that all workers can write in the store at the same time
+#   2) the columns are read as numpy (memory mapped) arrays, so that filtering the whole base is a mere vectorized
+#      comparison, e.g. all the BOSS images with a USM amount larger than 300:
+#      store.query(lambda c: (c["base"] == b"Boss_Base") & (c["amount"] > 300), ["name", "radius", "amount"])
+# Note that strings are stored as (fixed size) bytes.
+
+# Development parameters of an image, see From_RAW_to_JPG
+DEV_PARAM_SCHEMA = [("name", "S128"), ("base", "S64"), ("raw", "S128"), ("dem", "S64"),
+                    ("usm_before_denoise", "i1"), ("sharpening", "S8"), ("radius", "f8"), ("amount", "f8"),
+                    ("iterations", "i4"), ("denoise", "i1"), ("luminance", "f8"), ("detail", "f8"),
+                    ("subsampling_type", "i1"), ("resize_kernel", "S16"), ("subsampling_factor", "f8"),
+                    ("crop_height", "i4"), ("crop_width", "i4"), ("qf", "i4"), ("profile_md5", "S32")]
+
+
+class paramStore:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # store_dir is the directory of the store and schema the list of (column, numpy dtype); the rows are identified by
+    # the value of their column "key".
+    def __init__(self, store_dir, schema, key="name"):
+        self.store_dir = store_dir
+        self.schema = [(column, np.dtype(dtype)) for column, dtype in schema]
+        self.dtypes = dict(self.schema)
+        self.key = key
+        self.schema_path = os.path.join(store_dir, "schema.json")
+        # Row of each key, read incrementally from the key column (rows are never removed)
+        self.key_rows = dict()
+        self.nb_keys_read = 0
+
+    def column_path(self, column):
+        return os.path.join(self.store_dir, column + ".col")
+
+    # The store is created if it does not exist yet; an existing store must have the same schema
+    def create(self):
+        os.makedirs(self.store_dir, 0o755, exist_ok=True)
+        schema = [[column, dtype.str] for column, dtype in self.schema]
+        with shared_state.file_lock(self.schema_path):
+            if os.path.exists(self.schema_path):
+                if shared_state.read_json(self.schema_path, default=[]) != schema:
+                    raise ValueError("The parameter store {} has another schema, remove it".format(self.store_dir))
+                return
+            for column, _ in self.schema:
+                open(self.column_path(column), "ab").close()
+            shared_state.write_json(self.schema_path, schema)
+
+    # Number of complete rows (a row being written may not be in all the files yet)
+    def nb_rows(self):
+        return min(os.path.getsize(self.column_path(column)) // dtype.itemsize for column, dtype in self.schema)
+
+    # **************************#
+    # Writing of the rows #
+    # **************************#
+    def write_values(self, row_index, values):
+        for column, value in values.items():
+            dtype = self.dtypes[column]
+            if dtype.kind == "S" and isinstance(value, str):
+                value = value.encode("utf-8")
+            with open(self.column_path(column), "r+b") as column_file:
+                os.pwrite(column_file.fileno(), np.array([value], dtype=dtype).tobytes(), row_index * dtype.itemsize)
+
+    def read_keys(self):
+        dtype = self.dtypes[self.key]
+        with open(self.column_path(self.key), "rb") as key_file:
+            key_file.seek(self.nb_keys_read * dtype.itemsize)
+            data = key_file.read()
+        keys = np.frombuffer(data[:len(data) - len(data) % dtype.itemsize], dtype=dtype)
+        for key in keys:
+            self.key_rows[key.decode("utf-8") if dtype.kind == "S" else key] = self.nb_keys_read
+            self.nb_keys_read += 1
+
+    def contains(self, key):
+        if key not in self.key_rows:
+            with shared_state.file_lock(self.schema_path):
+                self.read_keys()
+        return key in self.key_rows
+
+    # Appends a row (dictionary column --> value, missing columns are set to 0 / empty) or, if a row with the same key
+    # already exists, overwrites it; returns the index of the row
+    def put(self, row):
+        values = {column: row.get(column, b"" if dtype.kind == "S" else 0) for column, dtype in self.schema}
+        with shared_state.file_lock(self.schema_path):
+            self.read_keys()
+            row_index = self.key_rows.get(row[self.key])
+            if row_index is None:
+                row_index = self.nb_rows()
+            self.write_values(row_index, values)
+        return row_index
+
+    # Update of some of the columns of a row
+    def update(self, row_index, **values):
+        with shared_state.file_lock(self.schema_path):
+            self.write_values(row_index, values)
+
+    # **************************#
+    # Reading and filtering #
+    # **************************#
+    # Dictionary column --> numpy (memory mapped) array of all the rows, for the given columns (all by default)
+    def columns(self, names=None):
+        nb_rows = self.nb_rows()
+        columns = dict()
+        for column in (names if names is not None else [column for column, _ in self.schema]):
+            if nb_rows == 0:
+                columns[column] = np.zeros(0, dtype=self.dtypes[column])
+            else:
+                columns[column] = np.memmap(self.column_path(column), dtype=self.dtypes[column], mode="r",
+                                            shape=(nb_rows,))
+        return columns
+
+    # Rows for which condition (a function of the dictionary of all columns returning a boolean array) is True, for the
+    # given columns (all by default)
+    def query(self, condition, names=None):
+        columns = self.columns()
+        mask = condition(columns)
+        return {column: np.asarray(columns[column][mask]) for column in (names if names is not None else columns)}
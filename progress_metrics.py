@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Script used to publish live counters during the generation of a base, without any scan of the output directories.
+# Each worker appends one small JSON line per event (start / end of the conversion of an image, success or failure of
+# a stage) to a "spool" file; the main process tails this file in a background thread, aggregates the events and
+# publishes:
+#   1) the number of images done / failed per stage and per source (RAW) base
+#   2) the throughput (images converted per minute, over a sliding window) and the ETA; the images skipped (already
+#      processed, up to date or quarantined) end at once, hence they are not counted in the throughput
+#   3) the worker utilization, i.e. the fraction of time workers spent converting images
+#   4) when the RAW images are read ahead (see "raw_prefetch.py"), the hit rate of the staged copies and the read
+#      bandwidth of the RAW disk
+# The metrics are written, in the Prometheus text format, into a "textfile" (for the node_exporter textfile collector)
+# and, optionally, served on http://localhost:<port>/metrics.
+
+
+# **************************#
+# Worker side: recording of one event #
+# **************************#
+def record_event(spool_path, kind, **fields):
+    fields["kind"] = kind
+    fields["time"] = time.time()
+    fields["pid"] = os.getpid()
+    # A worker is a joblib process or, in the asyncio orchestration, one of the image slots of the coordinator
+    fields.setdefault("worker", fields["pid"])
+    # The file is opened in append mode for each event: a single (small) write is never interleaved with the writes
+    # of other workers, and rotating the file (see metricsAggregator.collect) is safe.
+    with open(spool_path, "a") as spool_file:
+        spool_file.write(json.dumps(fields) + "\n")
+
+
+class metricsAggregator:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # final_stage is the stage whose success means that an image is done; nb_workers is the number of joblib workers
+    # (used for the utilization) and rate_window the duration (in seconds) of the window used for the throughput.
+    # The events are removed once the aggregator is stopped.
+    def __init__(self, spool_path, textfile_path, nb_workers, final_stage="done", interval=10, rate_window=600,
+                 http_port=None):
+        self.spool_path = spool_path
+        self.textfile_path = textfile_path
+        self.nb_workers = nb_workers
+        self.final_stage = final_stage
+        self.interval = interval
+        self.rate_window = rate_window
+        self.http_port = http_port
+
+        self.start_time = time.time()
+        self.planned = {}
+        self.counts = defaultdict(int)
+        # end of the conversions carried out (whatever their outcome), for the throughput
+        self.conversion_times = deque()
+        self.running = {}
+        self.finished = 0
+        self.busy_time = 0.
+        self.prefetch = defaultdict(int)
+        self.prefetch_bytes = 0
+        self.prefetch_seconds = 0.
+        self.read_offset = 0
+        self.text = ""
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+        # Events of a previous run are meaningless
+        for path in [self.spool_path, self.spool_path + ".reading"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Number of images that are going to be converted from the given RAW base
+    def set_planned(self, base, nb_images):
+        self.planned[base] = nb_images
+
+    # **************************#
+    # Aggregation of the new events #
+    # **************************#
+    def collect(self):
+        # The spool file is rotated (renamed into ".reading") once read, so that it never grows too much; the
+        # rotated file is read once more before being removed in case a worker has written to it in the meantime.
+        reading_path = self.spool_path + ".reading"
+        self.read_events(reading_path)
+        if os.path.exists(self.spool_path):
+            if os.path.exists(reading_path):
+                os.remove(reading_path)
+            os.replace(self.spool_path, reading_path)
+            self.read_offset = 0
+            self.read_events(reading_path)
+
+    def read_events(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as spool_file:
+            spool_file.seek(self.read_offset)
+            for line in spool_file:
+                if not line.endswith(b"\n"):  # event being written, it will be read next time
+                    break
+                self.read_offset += len(line)
+                try:
+                    self.process_event(json.loads(line.decode("utf-8")))
+                except ValueError:
+                    pass
+
+    def process_event(self, event):
+        if event["kind"] == "task_start":
+            self.running[event.get("worker", event["pid"])] = event["time"]
+        elif event["kind"] == "task_end":
+            # whatever the outcome (success, failure, skipped image), the image does not remain to be converted
+            self.finished += 1
+            if event.get("converted", True):
+                self.conversion_times.append(event["time"])
+            start = self.running.pop(event.get("worker", event["pid"]), None)
+            if start is not None:
+                self.busy_time += event["time"] - start
+        elif event["kind"] == "stage":
+            self.counts[(event["stage"], event["base"], event["status"])] += 1
+        elif event["kind"] == "prefetch":
+            self.prefetch[event["status"]] += 1
+        elif event["kind"] == "prefetch_read":
+            self.prefetch_bytes += event["bytes"]
+            self.prefetch_seconds += event["seconds"]
+
+    # **************************#
+    # Prometheus text format #
+    # **************************#
+    def render(self):
+        now = time.time()
+        while self.conversion_times and self.conversion_times[0] < now - self.rate_window:
+            self.conversion_times.popleft()
+        window = min(self.rate_window, now - self.start_time)
+        rate = len(self.conversion_times) / window * 60 if window > 0 else 0.
+
+        done = sum(count for (stage, _, status), count in self.counts.items()
+                   if stage == self.final_stage and status == "ok")
+        failed = sum(count for (_, _, status), count in self.counts.items() if status == "failed")
+        remaining = max(0, sum(self.planned.values()) - self.finished)
+        eta = remaining / rate * 60 if rate > 0 else (0 if remaining == 0 else -1)
+
+        busy = self.busy_time + sum(now - start for start in self.running.values())
+        utilization = busy / ((now - self.start_time) * self.nb_workers) if now > self.start_time else 0.
+
+        lines = ["# HELP jpeg_base_stage_images_total Images processed per stage, source base and status",
+                 "# TYPE jpeg_base_stage_images_total counter"]
+        for (stage, base, status), count in sorted(self.counts.items()):
+            lines.append('jpeg_base_stage_images_total{stage="%s",base="%s",status="%s"} %d'
+                         % (stage, base, status, count))
+        lines += ["# HELP jpeg_base_planned_images Images to be converted per source base",
+                  "# TYPE jpeg_base_planned_images gauge"]
+        for base, count in sorted(self.planned.items()):
+            lines.append('jpeg_base_planned_images{base="%s"} %d' % (base, count))
+        lines += ["# TYPE jpeg_base_images_done gauge", "jpeg_base_images_done %d" % done,
+                  "# TYPE jpeg_base_failures gauge", "jpeg_base_failures %d" % failed,
+                  "# TYPE jpeg_base_images_per_minute gauge", "jpeg_base_images_per_minute %.3f" % rate,
+                  "# TYPE jpeg_base_eta_seconds gauge", "jpeg_base_eta_seconds %.0f" % eta,
+                  "# TYPE jpeg_base_worker_utilization gauge", "jpeg_base_worker_utilization %.4f" % utilization,
+                  "# TYPE jpeg_base_elapsed_seconds gauge",
+                  "jpeg_base_elapsed_seconds %.0f" % (now - self.start_time)]
+        if self.prefetch or self.prefetch_bytes:
+            nb_claims = sum(self.prefetch.values())
+            lines += ["# HELP jpeg_base_prefetch_total RAW images demosaiced from their staged copy (hit) or not",
+                      "# TYPE jpeg_base_prefetch_total counter"]
+            for status in ["hit", "miss"]:
+                lines.append('jpeg_base_prefetch_total{status="%s"} %d' % (status, self.prefetch[status]))
+            lines += ["# TYPE jpeg_base_prefetch_hit_ratio gauge",
+                      "jpeg_base_prefetch_hit_ratio %.4f" % (self.prefetch["hit"] / nb_claims if nb_claims else 0.),
+                      "# TYPE jpeg_base_prefetch_read_bytes_total counter",
+                      "jpeg_base_prefetch_read_bytes_total %d" % self.prefetch_bytes,
+                      "# TYPE jpeg_base_prefetch_read_bytes_per_second gauge",
+                      "jpeg_base_prefetch_read_bytes_per_second %.0f" % (
+                          self.prefetch_bytes / self.prefetch_seconds if self.prefetch_seconds > 0 else 0.)]
+        return "\n".join(lines) + "\n"
+
+    def publish(self):
+        self.collect()
+        self.text = self.render()
+        tmp_path = self.textfile_path + ".tmp"
+        with open(tmp_path, "w") as textfile:
+            textfile.write(self.text)
+        os.replace(tmp_path, self.textfile_path)
+
+    # **************************#
+    # Background thread and HTTP endpoint #
+    # **************************#
+    def start(self):
+        def loop():
+            while not self.stop_event.wait(self.interval):
+                self.publish()
+
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+        if self.http_port is not None:
+            aggregator = self
+
+            class metricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = aggregator.text.encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.http_port), metricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print("Live metrics served on http://127.0.0.1:{}/metrics".format(self.http_port))
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.publish()
+        if self.server is not None:
+            self.server.shutdown()
+        for path in [self.spool_path, self.spool_path + ".reading"]:
+            if os.path.exists(path):
+                os.remove(path)
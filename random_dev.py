@@ -2,6 +2,8 @@ import numpy as np
 import shutil
 from PIL import Image
 
+from keyed_rng import keyedRandomState
+
 # Script used to randomly select the development parameters from RAW files to JPEG images.
 # This merely consists of a initializer ( the function __init__ ) and a "development profile" random generator.
 # The initializer is used to set all the development parameters; for simplicity we recall that those are the following:
@@ -23,6 +25,9 @@ from PIL import Image
 # Eventually, outside from rawtherapee software, we also specifies:
 #   6) JPEG compression quality factor
 #   7) final image size with of course two parameters.
+# Each parameter is drawn from its own "stream" (see the function stream): by default, all the streams are the same
+# sequential generator (np.random.RandomState), hence a parameter depends on all the draws made before it; with
+# keyed_rng, each parameter is drawn from (seed, name of the parameter) only (see "keyed_rng.py").
 
 KERNEL_dict = {Image.NEAREST: "NEAREST", Image.BILINEAR: "BILINEAR", Image.BICUBIC: "BICUBIC", Image.LANCZOS: "LANCZOS"}
 
@@ -34,7 +39,7 @@ class devRandomGenerator:
     # ***************************#
     # The goal of this function is to select randomly  function
     def __init__(self, qf, qf_probs, crop_size, dem, dem_probs, resize_kernel, resize_kernel_probs, seed=None,
-                 resize_size=None):
+                 resize_size=None, keyed_rng=False):
 
         # First define the different distributions
         # usm_radius_values = np.arange(0.3, 3 + 0.01, 0.01)
@@ -63,18 +68,21 @@ class devRandomGenerator:
         ])
         denois_lum_prob = denois_lum_prob / np.sum(denois_lum_prob)
 
-        self.r = np.random.RandomState(seed)
+        self.keyed_rng = keyed_rng
+        self.r = keyedRandomState(seed) if keyed_rng else np.random.RandomState(seed)
 
-        self.dem = {"dem_algorithm": lambda: self.r.choice(dem, p=dem_probs)}
-        self.usm = {"radius": lambda: self.r.choice(usm_radius_values, p=usm_radius_prob),
-                    "amount": lambda: self.r.choice(usm_amount_values, p=usm_amount_prob)}
+        self.dem = {"dem_algorithm": lambda: self.stream("dem").choice(dem, p=dem_probs)}
+        self.usm = {"radius": lambda: self.stream("usm_radius").choice(usm_radius_values, p=usm_radius_prob),
+                    "amount": lambda: self.stream("usm_amount").choice(usm_amount_values, p=usm_amount_prob)}
 
-        self.denois = {"luminance": lambda: self.r.choice(denois_lum_values, p=denois_lum_prob),
+        self.denois = {"luminance": lambda: self.stream("denoise_luminance").choice(denois_lum_values,
+                                                                                     p=denois_lum_prob),
                        # "detail": lambda: self.r.randint(low=0, high=60)}
-                       "detail": lambda: self.r.randint(low=0, high=40)}
+                       "detail": lambda: self.stream("denoise_detail").randint(low=0, high=40)}
 
-        self.microcontrast = {"quantity": lambda: min(round(self.r.gamma(1, 0.5) * 100), 100),
-                              "uniformity": lambda: max(0, round(self.r.normal(30, 5)))}
+        self.microcontrast = {
+            "quantity": lambda: min(round(self.stream("microcontrast_quantity").gamma(1, 0.5) * 100), 100),
+            "uniformity": lambda: max(0, round(self.stream("microcontrast_uniformity").normal(30, 5)))}
 
         # self.QF = {"QF": lambda: int(self.r.choice(qf, p=qf_probs))}
         self.QF = {"QF": lambda: qf}
@@ -82,93 +90,132 @@ class devRandomGenerator:
         if resize_size is not None:
             self.crop = {"size": lambda: [resize_size, resize_size]}
         else:
-            self.crop = {"size": lambda: self.r.choice(crop_size, 2)}
-        self.resize_kernel = {"kernel": lambda: self.r.choice(resize_kernel, p=resize_kernel_probs)}
-        self.resize_weight = {"factor": lambda: self.r.uniform(0, 1)}
+            self.crop = {"size": lambda: self.stream("crop_size").choice(crop_size, 2)}
+        self.resize_kernel = {"kernel": lambda: self.stream("resize_kernel").choice(resize_kernel,
+                                                                                    p=resize_kernel_probs)}
+        self.resize_weight = {"factor": lambda: self.stream("resize_weight").uniform(0, 1)}
+
+    # Generator from which the parameter key is drawn
+    def stream(self, key):
+        return self.r.stream(key) if self.keyed_rng else self.r
 
     # Random profile according to the probabilities associated with each development step, as step in the variable
     # process_config from the main script ALASKA_conversion.py, we pick, or not, a random value for each parameter
     # following the distribution defined in the initializer The development process is eventually written into a
-    # rawtherapee compatible pp3 file.
+    # rawtherapee compatible pp3 file (if outputPath is not None, see render_RT_profile).
     def generate_random_RT_profile(self, imageDevList, outputPath, backupfile):
         radius = 0
         amount = 0
         luminance = 0
         detail = 0
         USM_before_DENOISE = 1
+        sharpening = "none"
+        denoise = 0
 
-        # This is the pp3 file in which development parameters will be written for later used in rawtherapee.
-        currentProfile = open(outputPath, 'w+')
-        # Writing of the header of pp3 file.
-        currentProfile.write("[Version]\nAppVersion=5.4\nVersion=331\n\n")
         # Specifies if denoising is applied prior or after sharpening.
-        if self.r.binomial(1, 0.5) == 1:  # probability of 1/2 to start with unsharpening
+        if self.stream("usm_before_denoise").binomial(1, 0.5) == 1:  # probability of 1/2 to start with unsharpening
             # There we start we unsharpening mask and pick randomly the associated parameters (radius and amount)
             if imageDevList["choice"]["usm"] == 1:
+                sharpening = "usm"
                 radius = self.usm["radius"]()
                 amount = self.usm["amount"]()
-                currentProfile.write(
-                    "[Sharpening]\nEnabled=true\nMethod=usm\nRadius={}\nAmount={}\nThreshold=20;80;2000;1200;\n\n".format(
-                        radius, amount))
 
                 # and, in needed, specifies the parameters for the denoising
                 if imageDevList["choice"]["denois_if_usm"] == 1:
+                    denoise = 1
                     luminance = self.denois["luminance"]()
                     detail = self.denois["detail"]()
-                    currentProfile.write("[Directional Pyramid Denoising]\nEnabled=true\nEnhance=false\nMedian=false"
-                                         "\nLuma={}\nLdetail={}\n\n".format(luminance, detail))
 
                 # there the steps are applied in the other way round, i.e denoising first ....
         else:
             USM_before_DENOISE = 0
             if imageDevList["choice"]["denois"] == 1:
+                denoise = 1
                 luminance = self.denois["luminance"]()
                 detail = self.denois["detail"]()
-                currentProfile.write("[Directional Pyramid Denoising]\nEnabled=true\nEnhance=false\nMedian=false"
-                                     "\nLuma={}\nLdetail={}\n\n".format(luminance, detail))
                 # ... and then unsharpening mask.
                 if imageDevList["choice"]["usm_if_denois"] == 1:
+                    sharpening = "usm"
                     radius = self.usm["radius"]()
                     amount = self.usm["amount"]()
-                    currentProfile.write("[Sharpening]\nEnabled=true\nMethod=usm\nRadius={}\nAmount={}"
-                                         "\nThreshold=20;80;2000;1200;\n".format(radius, amount))
 
-        currentProfile.close()
+        # The parameters picked are kept along with the image development list (for logging purpose and to render the
+        # pp3 file)
+        imageDevList["profile"] = {"usm_before_denoise": USM_before_DENOISE, "sharpening": sharpening,
+                                   "radius": radius, "amount": amount, "denoise": denoise, "luminance": luminance,
+                                   "detail": detail}
 
-        # Optional: one can log all development parameters for all images into a single file. If so we write into a
-        # slightly more verbose the development parameters
+        # This is the pp3 file in which development parameters will be written for later used in rawtherapee.
+        if outputPath is not None:
+            with open(outputPath, 'w+') as currentProfile:
+                currentProfile.write(self.render_RT_profile(imageDevList["profile"]))
+
+        # Optional: one can log all development parameters for all images into a single file.
         if backupfile is not None:
-            BackupProfile = open(backupfile, 'a+')
-            if radius == 0 and amount == 0:
-                USM_set = "OFF"
-            else:
-                USM_set = "ON"
-
-            if luminance == 0 and detail == 0:
-                DENOISE_set = "OFF"
-            else:
-                DENOISE_set = "ON"
-
-            RESIZE_factor = imageDevList["subsampling_factor"]
-            if imageDevList["subsampling_type"] == 0:
-                RESIZE_set = "ON_WITH_CROP"
-                RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
-            elif imageDevList["subsampling_type"] == 1:
-                RESIZE_set = "ON_ALONE"
-                RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
-            elif imageDevList["subsampling_type"] == 2:
-                RESIZE_set = "CROP_ONLY"
-                RESIZE_kernel = "NONE"
-            else:
-                RESIZE_set = "OFF"
-
-            # The line written into the log file
-            BackupProfile.write("%30s | DEM %20s | %d | USM %3s , %5.2f , %6.2f | DENOISE %3s , %5.2f , %5.2f | "
-                                "RESIZE %s , %s , %5.5f | %4d x %4d | %3d \n" % (imageDevList["name"], imageDevList[
-                "dem"], USM_before_DENOISE, USM_set, radius, amount, DENOISE_set, luminance, detail, RESIZE_set,
-                                                                                 RESIZE_kernel, RESIZE_factor,
-                                                                                 imageDevList["crop_size"][0],
-                                                                                 imageDevList["crop_size"][1],
-                                                                                 imageDevList["qf"]))
+            self.write_backup_line(imageDevList, backupfile)
 
+    # Content of the rawtherapee compatible pp3 file of the parameters picked by generate_random_RT_profile; it is only
+    # rendered when rawtherapee needs it (the parameters themselves are stored in the parameter store, see
+    # "param_store.py")
+    @staticmethod
+    def render_RT_profile(profile):
+        # Writing of the header of pp3 file.
+        sections = ["[Version]\nAppVersion=5.4\nVersion=331\n\n"]
+        usm_section = "[Sharpening]\nEnabled=true\nMethod=usm\nRadius={}\nAmount={}" \
+                      "\nThreshold=20;80;2000;1200;\n".format(profile["radius"], profile["amount"])
+        denoise_section = "[Directional Pyramid Denoising]\nEnabled=true\nEnhance=false\nMedian=false" \
+                          "\nLuma={}\nLdetail={}\n\n".format(profile["luminance"], profile["detail"])
+        # Specifies if denoising is applied prior or after sharpening.
+        if profile["usm_before_denoise"] == 1:
+            if profile["sharpening"] == "usm":
+                sections.append(usm_section + "\n")
+            if profile["denoise"] == 1:
+                sections.append(denoise_section)
+        else:
+            if profile["denoise"] == 1:
+                sections.append(denoise_section)
+            if profile["sharpening"] == "usm":
+                sections.append(usm_section)
+        return "".join(sections)
+
+    # If so we write into a slightly more verbose the development parameters; note that this requires the resizing
+    # factor ( imageDevList["subsampling_factor"] ) which is only known once the resizing has been carried out.
+    def write_backup_line(self, imageDevList, backupfile):
+        radius = imageDevList["profile"]["radius"]
+        amount = imageDevList["profile"]["amount"]
+        luminance = imageDevList["profile"]["luminance"]
+        detail = imageDevList["profile"]["detail"]
+        USM_before_DENOISE = imageDevList["profile"]["usm_before_denoise"]
+        BackupProfile = open(backupfile, 'a+')
+        if radius == 0 and amount == 0:
+            USM_set = "OFF"
+        else:
+            USM_set = "ON"
+
+        if luminance == 0 and detail == 0:
+            DENOISE_set = "OFF"
+        else:
+            DENOISE_set = "ON"
+
+        RESIZE_factor = imageDevList["subsampling_factor"]
+        if imageDevList["subsampling_type"] == 0:
+            RESIZE_set = "ON_WITH_CROP"
+            RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
+        elif imageDevList["subsampling_type"] == 1:
+            RESIZE_set = "ON_ALONE"
+            RESIZE_kernel = KERNEL_dict[imageDevList["resize_kernel"]]
+        elif imageDevList["subsampling_type"] == 2:
+            RESIZE_set = "CROP_ONLY"
+            RESIZE_kernel = "NONE"
+        else:
+            RESIZE_set = "OFF"
+
+        # The line written into the log file
+        BackupProfile.write("%30s | DEM %20s | %d | USM %3s , %5.2f , %6.2f | DENOISE %3s , %5.2f , %5.2f | "
+                            "RESIZE %s , %s , %5.5f | %4d x %4d | %3d \n" % (imageDevList["name"], imageDevList[
+                                "dem"], USM_before_DENOISE, USM_set, radius, amount, DENOISE_set, luminance, detail,
+                                                                              RESIZE_set, RESIZE_kernel, RESIZE_factor,
+                                                                              imageDevList["crop_size"][0],
+                                                                              imageDevList["crop_size"][1],
+                                                                              imageDevList["qf"]))
         BackupProfile.close()
@@ -0,0 +1,214 @@
+import io
+import os
+import csv
+from hashlib import md5
+
+import numpy as np
+from PIL import Image
+from joblib import Parallel, delayed
+
+import shared_state
+
+# Script used to detect the RAW images present several times among the RAW bases (the same scene re-hosted in several
+# collections, possibly under another name), so that each scene is demosaiced and developed only once.
+# Each RAW file gets a "fingerprint" made of:
+#   1) "fast"   --> a hash of its size and of its first and last "chunk_size" bytes; files that share this hash are
+#                   then compared with a hash of their whole content ("full", computed only on such collisions)
+#   2) "dhash"  --> a 64 bits difference hash of its embedded preview (the largest JPEG stream found in the first
+#                   "preview_scan_size" bytes of the file); two files whose dHash differ by at most "max_distance" bits
+#                   are near-duplicates, e.g. the same shot whose metadata have been rewritten by the re-hosting, but
+#                   also two different shots of a burst or of a tripod series (same framing, hence almost the same
+#                   small preview).
+# The fingerprints are stored in a persistent index (see "shared_state.py"), keyed by path and invalidated when the
+# size or the modification date of the file changes; hence only the new RAW images are read by the next runs.
+# The first occurrence (in the order of the plan, i.e. of config_path["raw_dir"]) of each file is kept, the exact
+# duplicates are dropped from the plan and listed in a CSV report; the near-duplicates are only listed in the report
+# (and kept), unless "drop_near_duplicates" is set.
+
+DHASH_BANDS = 4
+
+
+# **************************#
+# Hashes of the content of a RAW file #
+# **************************#
+def fast_hash(path, chunk_size=2 ** 20):
+    size = os.path.getsize(path)
+    digest = md5(str(size).encode("utf-8"))
+    with open(path, "rb") as raw_file:
+        digest.update(raw_file.read(chunk_size))
+        if size > chunk_size:
+            raw_file.seek(max(chunk_size, size - chunk_size))
+            digest.update(raw_file.read(chunk_size))
+    return digest.hexdigest()
+
+
+def full_hash(path, chunk_size=2 ** 24):
+    digest = md5()
+    with open(path, "rb") as raw_file:
+        for chunk in iter(lambda: raw_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# **************************#
+# Difference hash of the embedded preview #
+# **************************#
+# The preview is the largest (in pixels) JPEG stream that PIL manages to read, the small thumbnails being too coarse;
+# returns None when the RAW file has no readable preview.
+def embedded_preview(path, scan_size=2 ** 23):
+    with open(path, "rb") as raw_file:
+        data = raw_file.read(scan_size)
+    preview, preview_pixels = None, 0
+    start = data.find(b"\xff\xd8\xff")
+    while start >= 0:
+        try:
+            image = Image.open(io.BytesIO(data[start:]))
+            if image.format == "JPEG" and image.size[0] * image.size[1] > preview_pixels:
+                preview, preview_pixels = image, image.size[0] * image.size[1]
+        except (IOError, OSError, SyntaxError, ValueError):
+            pass
+        start = data.find(b"\xff\xd8\xff", start + 3)
+    return preview
+
+
+def dhash(image, hash_size=8):
+    # The JPEG is decoded at a reduced scale (draft mode), which is enough for a 9x8 thumbnail
+    image.draft("L", (4 * hash_size, 4 * hash_size))
+    thumbnail = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def preview_dhash(path, scan_size=2 ** 23):
+    try:
+        preview = embedded_preview(path, scan_size)
+        return None if preview is None else dhash(preview)
+    except (IOError, OSError, SyntaxError, ValueError):
+        return None
+
+
+def hamming(hash_1, hash_2):
+    return bin(hash_1 ^ hash_2).count("1")
+
+
+# Fingerprint of a RAW file, as stored in the index
+def fingerprint(path, near_duplicates, chunk_size, scan_size):
+    stat = os.stat(path)
+    entry = {"size": stat.st_size, "mtime": int(stat.st_mtime), "fast": fast_hash(path, chunk_size)}
+    if near_duplicates:
+        entry["dhash"] = preview_dhash(path, scan_size)
+    return entry
+
+
+class rawDeduplicator:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # index_path is the JSON file of the fingerprints (kept from one run to the next), report_path the CSV file listing
+    # the duplicates found; near-duplicates (same embedded preview up to max_distance bits of dHash) are only looked
+    # for if near_duplicates is set, and only dropped if drop_near_duplicates is set. Note that max_distance must be
+    # lower than DHASH_BANDS for the search to be exact.
+    def __init__(self, index_path, report_path, near_duplicates=True, drop_near_duplicates=False, max_distance=3,
+                 n_jobs=1, chunk_size=2 ** 20, preview_scan_size=2 ** 23):
+        self.index_path = index_path
+        self.report_path = report_path
+        self.near_duplicates = near_duplicates
+        self.drop_near_duplicates = drop_near_duplicates
+        self.max_distance = min(max_distance, DHASH_BANDS - 1)
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.preview_scan_size = preview_scan_size
+
+    # **************************#
+    # Fingerprints, read from the index or computed #
+    # **************************#
+    def fingerprints(self, paths):
+        index = shared_state.read_json(self.index_path)
+        to_compute = []
+        for path in paths:
+            entry = index.get(path)
+            stat = os.stat(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != int(stat.st_mtime) or \
+                    (self.near_duplicates and "dhash" not in entry):
+                to_compute.append(path)
+        if to_compute:
+            print("Fingerprinting " + str(len(to_compute)) + " RAW images (" + str(len(paths) - len(to_compute)) +
+                  " already indexed)")
+            entries = Parallel(n_jobs=self.n_jobs)(
+                delayed(fingerprint)(path, self.near_duplicates, self.chunk_size, self.preview_scan_size)
+                for path in to_compute)
+            for path, entry in zip(to_compute, entries):
+                index[path] = entry
+        return index
+
+    # The full hash is computed only once per file, and only for the files sharing their fast hash with another one
+    def full_hashes(self, index, paths):
+        missing = [path for path in paths if "full" not in index[path]]
+        hashes = Parallel(n_jobs=self.n_jobs)(delayed(full_hash)(path) for path in missing)
+        for path, content_hash in zip(missing, hashes):
+            index[path]["full"] = content_hash
+
+    # **************************#
+    # Deduplication of the plan #
+    # **************************#
+    # plan is a list of (RAW folder, directory path, list of RAW file names); returns the same list without the
+    # duplicates dropped, along with the list of the duplicates found as (duplicate path, original path, kind,
+    # distance).
+    def deduplicate(self, plan):
+        paths = [os.path.join(raw_dir, name) for _, raw_dir, names in plan for name in names]
+        index = self.fingerprints(paths)
+
+        # Exact duplicates: same fast hash, then same full hash
+        by_fast = {}
+        for path in paths:
+            by_fast.setdefault(index[path]["fast"], []).append(path)
+        self.full_hashes(index, [path for group in by_fast.values() if len(group) > 1 for path in group])
+        shared_state.update_json(self.index_path, lambda stored: stored.update({path: index[path] for path in paths}))
+
+        duplicates = {}
+        kept_by_content = {}
+        for path in paths:
+            key = index[path].get("full", index[path]["fast"])
+            if key in kept_by_content:
+                duplicates[path] = (kept_by_content[key], "exact", 0)
+            else:
+                kept_by_content[key] = path
+
+        # Near-duplicates: if two dHash differ by less than DHASH_BANDS bits, at least one of their DHASH_BANDS bands
+        # of bits is identical, hence only the images sharing a band are compared
+        if self.near_duplicates:
+            bands = {}
+            band_bits = 64 // DHASH_BANDS
+            order = {path: rank for rank, path in enumerate(paths)}
+            for path in paths:
+                image_hash = index[path].get("dhash")
+                if path in duplicates or image_hash is None:
+                    continue
+                image_bands = [(b, (image_hash >> (b * band_bits)) & (2 ** band_bits - 1)) for b in range(DHASH_BANDS)]
+                candidates = set(other for band in image_bands for other in bands.get(band, []))
+                matches = sorted((hamming(image_hash, index[other]["dhash"]), order[other], other)
+                                 for other in candidates)
+                if matches and matches[0][0] <= self.max_distance:
+                    duplicates[path] = (matches[0][2], "near", matches[0][0])
+                    continue
+                for band in image_bands:
+                    bands.setdefault(band, []).append(path)
+
+        dropped = set(path for path in duplicates if duplicates[path][1] == "exact" or self.drop_near_duplicates)
+        self.write_report(duplicates, dropped)
+        deduplicated_plan = [(raw_folder, raw_dir, [name for name in names
+                                                    if os.path.join(raw_dir, name) not in dropped])
+                             for raw_folder, raw_dir, names in plan]
+        return deduplicated_plan, [(path,) + duplicates[path] for path in paths if path in duplicates]
+
+    def write_report(self, duplicates, dropped):
+        with open(self.report_path, "w") as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["duplicate", "original", "kind", "distance", "dropped"])
+            for path in sorted(duplicates):
+                writer.writerow([path] + list(duplicates[path]) + [int(path in dropped)])
+        nb_exact = sum(1 for d in duplicates.values() if d[1] == "exact")
+        nb_near_dropped = len(dropped) - nb_exact
+        print("Duplicate RAW images skipped: " + str(nb_exact) + " exact, " + str(nb_near_dropped) +
+              " near-duplicates; near-duplicates kept: " + str(len(duplicates) - len(dropped)) + " (see " +
+              self.report_path + ")")
@@ -0,0 +1,147 @@
+import os
+import time
+import shutil
+import threading
+
+from progress_metrics import record_event
+
+# Script used to read the RAW images ahead of the workers. The RAW bases are usually stored on a slow (external, hard)
+# disk and the workers read the images in a random order (see image_indices), hence mostly wait for disk seeks. A
+# thread of the main process goes through the images in the order in which the workers will convert them, "window"
+# images at a time, reads each window in the order of the files on the disk (approximated by their inode number) and
+# copies the images into a "staging" directory on a fast disk (local SSD or RAM, e.g. /dev/shm); at most "max_bytes"
+# are staged at any time.
+# The staged copies are shared with the workers through the file system only (no lock is needed, renames being atomic):
+#   1) "<base>/<name>.part"     --> copy in progress
+#   2) "<base>/<name>"          --> copy ready
+#   3) "<base>/in_use/<name>"   --> copy taken by a worker (claim_staged_raw), which removes it once the image is
+#                                   demosaiced (release_staged_raw)
+#   4) "<base>/<name>.consumed" --> the worker reached the image before its copy was ready (a "miss") and read the RAW
+#                                   disk instead; the copy is then not made or, if it was made in the meantime, removed
+# Note that the staged copy is only used to read the RAW image: the identity of the image (quarantine, stage hashes,
+# manifest ...) is always its path in the RAW base.
+
+
+def staged_raw_path(staging_dir, raw_path):
+    return os.path.join(staging_dir, os.path.basename(os.path.dirname(raw_path)), os.path.basename(raw_path))
+
+
+def in_use_raw_path(staging_dir, raw_path):
+    staged_path = staged_raw_path(staging_dir, raw_path)
+    return os.path.join(os.path.dirname(staged_path), "in_use", os.path.basename(staged_path))
+
+
+# **************************#
+# Worker side: use of the staged copies #
+# **************************#
+# Returns the path of the staged copy of raw_path, taken by the worker, or None if it is not ready (miss)
+def claim_staged_raw(staging_dir, raw_path):
+    staged_path = staged_raw_path(staging_dir, raw_path)
+    in_use_path = in_use_raw_path(staging_dir, raw_path)
+    os.makedirs(os.path.dirname(in_use_path), 0o755, exist_ok=True)
+    try:
+        os.rename(staged_path, in_use_path)
+        return in_use_path
+    except OSError:
+        pass
+    open(staged_path + ".consumed", "w").close()
+    # The copy may have been made ready between the rename and the marker
+    try:
+        os.rename(staged_path, in_use_path)
+        return in_use_path
+    except OSError:
+        return None
+
+
+def release_staged_raw(staging_dir, raw_path):
+    try:
+        os.remove(in_use_raw_path(staging_dir, raw_path))
+    except OSError:
+        pass
+
+
+class rawPrefetcher:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # The read of each image (size and duration) is recorded in the spool of the live metrics, if given
+    def __init__(self, staging_dir, max_bytes, window=64, spool_path=None, poll_interval=0.2):
+        self.staging_dir = staging_dir
+        self.max_bytes = max_bytes
+        self.window = window
+        self.spool_path = spool_path
+        self.poll_interval = poll_interval
+        # Size of the copies made, which stay in the staging directory until they are released by a worker
+        self.staged = dict()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # **************************#
+    # Copies #
+    # **************************#
+    def staged_bytes(self):
+        for raw_path in list(self.staged):
+            if not os.path.exists(staged_raw_path(self.staging_dir, raw_path)) and \
+                    not os.path.exists(in_use_raw_path(self.staging_dir, raw_path)):
+                del self.staged[raw_path]
+        return sum(self.staged.values())
+
+    def stage(self, raw_path):
+        staged_path = staged_raw_path(self.staging_dir, raw_path)
+        size = os.path.getsize(raw_path)
+        if size > self.max_bytes:
+            return
+        # Waiting for the workers to release enough copies
+        while self.staged_bytes() + size > self.max_bytes:
+            if self.stop_event.wait(self.poll_interval):
+                return
+        if os.path.exists(staged_path + ".consumed"):
+            return
+        os.makedirs(os.path.dirname(staged_path), 0o755, exist_ok=True)
+        start = time.time()
+        shutil.copyfile(raw_path, staged_path + ".part")
+        duration = time.time() - start
+        os.replace(staged_path + ".part", staged_path)
+        self.staged[raw_path] = size
+        if self.spool_path is not None:
+            record_event(self.spool_path, "prefetch_read", bytes=size, seconds=duration)
+        # The worker missed the copy (see claim_staged_raw): nobody will release it
+        if os.path.exists(staged_path + ".consumed"):
+            try:
+                os.remove(staged_path)
+            except OSError:
+                pass
+
+    # Position of a file on the disk, approximated by its inode number (files written in a row get close inodes)
+    @staticmethod
+    def disk_position(raw_path):
+        stat = os.stat(raw_path)
+        return stat.st_dev, stat.st_ino
+
+    def run(self, raw_paths):
+        for first in range(0, len(raw_paths), self.window):
+            window = sorted(raw_paths[first:first + self.window], key=self.disk_position)
+            for raw_path in window:
+                if self.stop_event.is_set():
+                    return
+                try:
+                    self.stage(raw_path)
+                except OSError as error:
+                    print("[WARNING] Prefetch of " + raw_path + " failed: " + repr(error))
+
+    # **************************#
+    # Background thread #
+    # **************************#
+    # raw_paths are all the RAW images, in the order in which they are going to be converted
+    def start(self, raw_paths):
+        if os.path.exists(self.staging_dir):
+            shutil.rmtree(self.staging_dir)
+        os.makedirs(self.staging_dir, 0o755)
+        self.thread = threading.Thread(target=self.run, args=(list(raw_paths),), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
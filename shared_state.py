@@ -0,0 +1,55 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+
+# Small helpers used to share a (tiny) persistent state between the joblib workers and between successive runs of
+# the generator (see for instance the decoder routing table in "decoder_routing.py").
+# The state is merely stored as a JSON file; every read-modify-write cycle is protected by an exclusive lock taken on
+# a companion ".lock" file so that several workers, or several instances of the script launched at the same time (see
+# Section "Parallelization" in the pdf documentation), never overwrite the updates of each other.
+
+
+# **************************#
+# Exclusive lock on a state file #
+# **************************#
+@contextmanager
+def file_lock(path):
+    lock_file = open(path + ".lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+# **************************#
+# Reading / writing of a JSON state file #
+# **************************#
+def read_json(path, default=None):
+    # A missing (or, for whatever reason, corrupted) file is simply considered as an empty state
+    try:
+        with open(path, "r") as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {} if default is None else default
+
+
+def write_json(path, data):
+    # The file is first written aside and then renamed, hence a reader never sees a half written file (the temporary
+    # file is proper to the process and thread)
+    tmp_path = path + ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+    with open(tmp_path, "w") as state_file:
+        json.dump(data, state_file, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def update_json(path, update_fun, default=None):
+    # update_fun receives the current state, modifies it in place and may return a value which is forwarded
+    with file_lock(path):
+        data = read_json(path, default)
+        result = update_fun(data)
+        write_json(path, data)
+    return result
@@ -0,0 +1,67 @@
+import os
+import json
+from hashlib import md5
+
+import shared_state
+
+# Script used to rebuild a base incrementally.
+# The conversion of an image is made of several stages (demosaicing, resizing, development, JPEG compression and
+# multi crop); the output of each stage is tagged with a hash of its input (that is, the hash of the previous stage)
+# and of all the parameters it consumed. Those hashes are stored, for each image, in a small JSON "stamp" file.
+# When the base is rebuilt after a change of configuration, a stage is run again only if its hash changed or if its
+# output is missing; e.g. changing the JPEG quality factor only re-encodes the developed TIFF images.
+
+
+# **************************#
+# Hash of a stage #
+# **************************#
+def stage_hash(parent_hash, params):
+    # default=str handles numpy values (e.g. crop size picked by the random generator)
+    description = json.dumps([parent_hash, params], sort_keys=True, default=str)
+    return md5(description.encode("utf-8")).hexdigest()
+
+
+# Identity of an input file; RAW images are never modified, hence their path, size and modification date are enough
+# (and much cheaper than hashing their content)
+def file_identity(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+def file_content_hash(path):
+    with open(path, "rb") as input_file:
+        return md5(input_file.read()).hexdigest()
+
+
+class stageCache:
+    # ***************************#
+    # Main function: initializer #
+    # ***************************#
+    # stamp_dir is the directory in which the stamp file of every image is stored.
+    def __init__(self, stamp_dir):
+        self.stamp_dir = stamp_dir
+
+    def stamp_path(self, image_name):
+        return os.path.join(self.stamp_dir, image_name + ".json")
+
+    # All the stamps of an image, as a dictionary stage --> {"hash": ..., other stored values}
+    def load(self, image_name):
+        return shared_state.read_json(self.stamp_path(image_name))
+
+    # A stage is "fresh" (needs not be run again) if its hash did not change and all its outputs do exist; when the
+    # outputs are not known beforehand (None), those stored along with the hash are checked.
+    @staticmethod
+    def is_fresh(stamps, stage, current_hash, outputs):
+        if stage not in stamps or stamps[stage]["hash"] != current_hash:
+            return False
+        if outputs is None:
+            outputs = stamps[stage].get("outputs", [])
+        return all(os.path.exists(o) for o in outputs)
+
+    # Stores the hash of a stage that just ran successfully, along with values that are needed by the next stages
+    # when this one is skipped (e.g. the resizing factor)
+    def store(self, image_name, stage, current_hash, **values):
+        stamps = self.load(image_name)
+        values["hash"] = current_hash
+        stamps[stage] = values
+        shared_state.write_json(self.stamp_path(image_name), stamps)
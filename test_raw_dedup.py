@@ -0,0 +1,54 @@
+import io
+import os
+import csv
+
+import numpy as np
+from PIL import Image
+
+from raw_dedup import rawDeduplicator
+
+
+# Fake RAW file: random bytes around an embedded JPEG preview of a smooth pattern (seed), the bytes of the "sensor
+# data" (content_seed) being different from one shot to the other
+def write_fake_raw(path, seed, content_seed):
+    y, x = np.mgrid[0:240, 0:320]
+    preview = np.sin(x / (10. + 3 * seed)) * np.cos(y / (7. + 2 * seed)) * 100 + 128
+    jpeg = io.BytesIO()
+    Image.fromarray(preview.clip(0, 255).astype(np.uint8)).save(jpeg, "JPEG", quality=85)
+    random_state = np.random.RandomState(content_seed)
+    with open(path, "wb") as raw_file:
+        raw_file.write(random_state.bytes(5000))
+        raw_file.write(jpeg.getvalue())
+        raw_file.write(random_state.bytes(30000))
+
+
+def deduplicate(tmp_path, names, **kwargs):
+    deduplicator = rawDeduplicator(str(tmp_path / "index.json"), str(tmp_path / "report.csv"), **kwargs)
+    plan, duplicates = deduplicator.deduplicate([("Base", str(tmp_path / "Base"), names)])
+    with open(str(tmp_path / "report.csv")) as report_file:
+        report = list(csv.DictReader(report_file))
+    return plan[0][2], duplicates, report
+
+
+def test_similar_previews_are_reported_but_kept(tmp_path):
+    os.makedirs(str(tmp_path / "Base"))
+    # Two different shots (e.g. of a burst) with the same preview, and an exact copy of the first one
+    write_fake_raw(str(tmp_path / "Base" / "shot1.NEF"), 1, 1)
+    write_fake_raw(str(tmp_path / "Base" / "shot2.NEF"), 1, 2)
+    write_fake_raw(str(tmp_path / "Base" / "copy1.NEF"), 1, 1)
+
+    kept, duplicates, report = deduplicate(tmp_path, ["shot1.NEF", "shot2.NEF", "copy1.NEF"])
+    assert kept == ["shot1.NEF", "shot2.NEF"]
+    kinds = {os.path.basename(path): kind for path, _, kind, _ in duplicates}
+    assert kinds == {"copy1.NEF": "exact", "shot2.NEF": "near"}
+    assert {row["kind"]: row["dropped"] for row in report} == {"exact": "1", "near": "0"}
+
+
+def test_similar_previews_are_dropped_on_demand(tmp_path):
+    os.makedirs(str(tmp_path / "Base"))
+    write_fake_raw(str(tmp_path / "Base" / "shot1.NEF"), 1, 1)
+    write_fake_raw(str(tmp_path / "Base" / "shot2.NEF"), 1, 2)
+    write_fake_raw(str(tmp_path / "Base" / "other.NEF"), 4, 3)
+
+    kept, _, _ = deduplicate(tmp_path, ["shot1.NEF", "shot2.NEF", "other.NEF"], drop_near_duplicates=True)
+    assert kept == ["shot1.NEF", "other.NEF"]
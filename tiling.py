@@ -0,0 +1,119 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Script used to cut (developed) images into tiles.
+# All tiles are "views" of the image array, i.e. no pixel is copied: a tile is merely a window over the memory of the
+# image. The tiling is defined by:
+#   1) "tile_size"      --> the size of the tiles, either an integer (square tiles) or a pair (height, width)
+#   2) "stride"         --> the shift between two consecutive tiles (same format); by default equal to the tile size,
+#                           a smaller stride gives overlapping tiles
+#   3) "edge_policy"    --> what to do when the tiles do not fit exactly in the image:
+#                           "drop"  the tiles that would go beyond the image border are dropped
+#                           "shift" an extra row / column of tiles is aligned on the image border (it overlaps the
+#                                   previous one)
+#                           "pad"   the image is padded (by mirroring, a single copy of the image) so that the tiles
+#                                   that go beyond the border are complete.
+# The regular grids ("drop" and "pad" policies) are a single strided view of the image (see tile_view), and the tiles
+# can be handed by batches (see tile_batches) e.g. to the encoder.
+# Note that, as opposed to numpy convention in the rest of the scripts, we name the dimensions height (rows, first
+# axis) and width (columns, second axis).
+
+EDGE_POLICIES = ["drop", "shift", "pad"]
+
+
+def as_pair(value):
+    if np.isscalar(value):
+        return int(value), int(value)
+    return int(value[0]), int(value[1])
+
+
+# **************************#
+# Origins of the tiles along one axis #
+# **************************#
+def axis_origins(length, tile, stride, edge_policy):
+    if edge_policy not in EDGE_POLICIES:
+        raise ValueError("Unknown edge policy {} (expected one of {})".format(edge_policy, EDGE_POLICIES))
+    if edge_policy == "pad":
+        # As many tiles as needed to cover the whole axis
+        nb_tiles = 1 + max(0, int(np.ceil((length - tile) / stride)))
+        return list(range(0, nb_tiles * stride, stride))
+    origins = list(range(0, length - tile + 1, stride))
+    if edge_policy == "shift" and length >= tile and (not origins or origins[-1] + tile < length):
+        origins.append(length - tile)
+    return origins
+
+
+# Image padded (if needed) for the "pad" policy, so that all tiles fit
+def padded_image(im, tile_size, stride, edge_policy):
+    tile_h, tile_w = as_pair(tile_size)
+    stride_h, stride_w = as_pair(stride if stride is not None else tile_size)
+    rows = axis_origins(im.shape[0], tile_h, stride_h, edge_policy)
+    cols = axis_origins(im.shape[1], tile_w, stride_w, edge_policy)
+    if edge_policy == "pad":
+        pad_h = max(0, rows[-1] + tile_h - im.shape[0]) if rows else 0
+        pad_w = max(0, cols[-1] + tile_w - im.shape[1]) if cols else 0
+        if pad_h > 0 or pad_w > 0:
+            padding = [(0, pad_h), (0, pad_w)] + [(0, 0)] * (im.ndim - 2)
+            im = np.pad(im, padding, mode="symmetric")
+    return im, rows, cols
+
+
+# **************************#
+# Regular grid of tiles as a single strided view #
+# **************************#
+# Array of shape (nb_rows, nb_cols, tile_height, tile_width[, channels]) sharing the memory of the image
+def strided_view(im, nb_rows, nb_cols, tile_size, stride):
+    tile_h, tile_w = as_pair(tile_size)
+    stride_h, stride_w = as_pair(stride if stride is not None else tile_size)
+    shape = (nb_rows, nb_cols, tile_h, tile_w) + im.shape[2:]
+    strides = (im.strides[0] * stride_h, im.strides[1] * stride_w) + im.strides
+    return as_strided(im, shape=shape, strides=strides, writeable=False)
+
+
+# Only for the "drop" and "pad" policies, whose grids are regular
+def tile_view(im, tile_size, stride=None, edge_policy="drop"):
+    if edge_policy == "shift":
+        raise ValueError("The grid of the \"shift\" policy is not regular, use iter_tiles instead")
+    im, rows, cols = padded_image(im, tile_size, stride, edge_policy)
+    return strided_view(im, len(rows), len(cols), tile_size, stride)
+
+
+# **************************#
+# Iteration over the tiles #
+# **************************#
+# Yields, for each tile, (index, row, column, tile) where (row, column) is the position of the upper left pixel of the
+# tile in the image and tile is a view of the image (of the strided view of the grid, but for the "shift" policy)
+def iter_tiles(im, tile_size, stride=None, edge_policy="drop"):
+    tile_h, tile_w = as_pair(tile_size)
+    im, rows, cols = padded_image(im, tile_size, stride, edge_policy)
+    view = strided_view(im, len(rows), len(cols), tile_size, stride) if edge_policy != "shift" else None
+    index = 0
+    for i, row in enumerate(rows):
+        for j, col in enumerate(cols):
+            yield index, row, col, view[i, j] if view is not None else im[row:row + tile_h, col:col + tile_w]
+            index += 1
+
+
+# Lists of (at most) batch_size consecutive items, e.g. of tiles to hand to the encoder
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Same as iter_tiles, by batches of (at most) batch_size tiles
+def tile_batches(im, tile_size, stride=None, edge_policy="drop", batch_size=16):
+    return batches(iter_tiles(im, tile_size, stride, edge_policy), batch_size)
+
+
+# Number of tiles of the tiling of an image of the given shape
+def nb_tiles(shape, tile_size, stride=None, edge_policy="drop"):
+    tile_h, tile_w = as_pair(tile_size)
+    stride_h, stride_w = as_pair(stride if stride is not None else tile_size)
+    return len(axis_origins(shape[0], tile_h, stride_h, edge_policy)) * \
+        len(axis_origins(shape[1], tile_w, stride_w, edge_policy))